@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+""" Per-call cost of the built-in jinja filters.
+
+Each filter is timed with a cold cache (all values distinct) and a warm cache (values repeating
+like categories or dates do in a catalog). datetime_format is also compared to plain dateparser.
+
+    pip install -e .
+    python benchmarks/bench_filters.py
+"""
+import timeit
+
+import dateparser
+
+from target_miso import extensions
+
+
+def dateparser_format(value: str) -> str:
+    """ datetime_format before the ISO fast path """
+    dt = dateparser.parse(value)
+    return dt.replace(microsecond=0).isoformat()
+
+
+def distinct_values(name: str, count: int):
+    if name == 'datetime_format':
+        return [f'2022-{1 + i % 12:02d}-{1 + i % 28:02d}T{i % 24:02d}:{i % 60:02d}:{(i * 7) % 60:02d}Z'
+                for i in range(count)]
+    if name == 'fix_url':
+        return [f'https://example.com/images/product {i}/front view.jpg' for i in range(count)]
+    return [f'He said "hello"\r\nto product “{i}”\\N\n' for i in range(count)]
+
+
+def bench(func, values, number=3):
+    def run():
+        for value in values:
+            func(value)
+    return min(timeit.repeat(run, number=1, repeat=number)) / len(values) * 1e6
+
+
+def main(count=2000):
+    print(f'{"filter":40s} {"us/call":>10s}')
+    for name in ('datetime_format', 'fix_url', 'remove_symbol'):
+        func = getattr(extensions, name)
+        values = distinct_values(name, count)
+        func.cache_clear()
+        cold = bench(lambda value: (func.cache_clear(), func(value)), values)
+        repeated = values[:50] * (count // 50)
+        warm = bench(func, repeated)
+        print(f'{name + " (cold cache)":40s} {cold:10.2f}')
+        print(f'{name + " (repeated values)":40s} {warm:10.2f}')
+    print(f'{"dateparser.parse (reference)":40s} {bench(dateparser_format, distinct_values("datetime_format", 200)):10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+""" Per-record cost of the skip-unchanged check.
+
+    pip install -e .
+    python benchmarks/bench_fingerprint.py
+"""
+import timeit
+
+from target_miso.fingerprint import fingerprint, legacy_md5
+from target_miso.target import is_upload_needed, update_state
+from target_miso.upload_state import DictUploadState
+
+RECORD = {
+    'product_id': 'P-0012345',
+    'title': 'Stainless steel water bottle 750ml',
+    'description': 'Double-walled, vacuum insulated bottle keeping drinks cold for 24 hours. ' * 5,
+    'categories': [['Home', 'Kitchen'], ['Outdoor']],
+    'price': 24.99,
+    'available': True,
+    'custom_attributes': {'brand': 'Miso', 'colors': ['black', 'white', 'green'], 'rating': 4.7},
+}
+
+
+def old_path(upload_state):
+    # hash in is_upload_needed, then again in update_state
+    legacy_hash = legacy_md5(RECORD)
+    if upload_state.get('s', 'a') != legacy_hash:
+        upload_state.set('s', 'a', legacy_md5(RECORD))
+
+
+def new_path(upload_state, algorithm):
+    record_hash = fingerprint(RECORD, algorithm)
+    if is_upload_needed(upload_state, 's', 'a', RECORD, record_hash):
+        update_state(upload_state, 's', 'a', RECORD, record_hash)
+
+
+def main(number=20000):
+    cases = {
+        'md5, hashed twice (before)': lambda: old_path(DictUploadState()),
+        'md5, hashed once': lambda: new_path(DictUploadState(), 'md5'),
+        'blake2b, hashed once': lambda: new_path(DictUploadState(), 'blake2b'),
+    }
+    try:
+        fingerprint(RECORD, 'xxhash')
+        cases['xxhash, hashed once'] = lambda: new_path(DictUploadState(), 'xxhash')
+    except ValueError:
+        pass
+    for name, func in cases.items():
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        print(f'{name:30s} {seconds / number * 1e6:8.2f} us/record')
+
+
+if __name__ == '__main__':
+    main()
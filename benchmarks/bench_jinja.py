@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+""" Rendering a wide product record: jinja text + json.loads against a field mapping template.
+
+    pip install -e .
+    python benchmarks/bench_jinja.py
+"""
+import json
+import timeit
+
+from target_miso.extensions import FieldMapping, get_jinja_env
+
+WIDTH = 40
+
+
+def wide_record(i: int):
+    record = {f'attr_{n}': f'value {n} of product {i}' for n in range(WIDTH)}
+    record.update({'id': f'P-{i}', 'title': f'Product "{i}"', 'image': f'https://x.com/img/{i} front.jpg',
+                   'updated_at': '2022-03-26T18:45:53Z', 'category': 'Kitchen'})
+    return record
+
+
+def main(number=3000):
+    env = get_jinja_env('.')
+    attributes = ',\n'.join(f'    "attr_{n}": {{{{ data.attr_{n} | jsonify }}}}' for n in range(WIDTH))
+    text_template = env.from_string(
+        '{\n'
+        '  "product_id": {{ data.id | jsonify }},\n'
+        '  "title": "{{ data.title | remove_symbol }}",\n'
+        '  "url": "{{ data.image | fix_url }}",\n'
+        '  "updated_at": "{{ data.updated_at | datetime_format }}",\n'
+        '  "categories": {{ data.category | convert_categories | jsonify }},\n'
+        '  "custom_attributes": {\n' + attributes + '\n  }\n}')
+    mapping = FieldMapping({
+        'product_id': 'data.id',
+        'title': 'data.title | remove_symbol',
+        'url': 'data.image | fix_url',
+        'updated_at': 'data.updated_at | datetime_format',
+        'categories': 'data.category | convert_categories',
+        'custom_attributes': {f'attr_{n}': f'data.attr_{n}' for n in range(WIDTH)},
+    }, env)
+    records = [wide_record(i) for i in range(number)]
+    assert json.loads(text_template.render(data=records[0])) == mapping.render_object(records[0])
+
+    cases = {
+        'jinja text + json.loads': lambda: [json.loads(text_template.render(data=r)) for r in records],
+        'field mapping': lambda: [mapping.render_object(r) for r in records],
+    }
+    for name, func in cases.items():
+        seconds = min(timeit.repeat(func, number=1, repeat=3))
+        print(f'{name:25s} {seconds / number * 1e6:8.2f} us/record')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+""" Parse throughput of singer messages, singer-python against the fast parser.
+
+    pip install -e .
+    python benchmarks/bench_parse.py
+"""
+import json
+import time
+
+from target_miso.transform import parse_messages
+
+
+def singer_stream(records: int):
+    """ A tap output with a schema, records, and a state every 1000 records """
+    lines = [json.dumps({"type": "SCHEMA", "stream": "products", "key_properties": ["id"],
+                         "schema": {"type": "object", "properties": {"id": {"type": "string"}}}})]
+    for i in range(records):
+        lines.append(json.dumps({
+            "type": "RECORD", "stream": "products", "time_extracted": "2022-03-26T18:45:53.123456Z",
+            "record": {"id": f"P-{i:08d}", "title": f"Product {i}", "price": round(i * 0.37, 2),
+                       "description": "A fairly long product description. " * 8,
+                       "categories": ["Home", "Kitchen"], "updated_at": "2022-03-26T18:45:53+00:00"}}))
+        if i % 1000 == 999:
+            lines.append(json.dumps({"type": "STATE", "value": {"bookmarks": {"products": i}}}))
+    lines.append(json.dumps({"type": "ACTIVATE_VERSION", "stream": "products", "version": 1}))
+    return lines
+
+
+def main(records=50000):
+    lines = singer_stream(records)
+    for name, fast in (('singer.parse_message', False), ('fast parser', True)):
+        start = time.perf_counter()
+        for _ in parse_messages(lines, fast=fast):
+            pass
+        elapsed = time.perf_counter() - start
+        print(f'{name:22s} {len(lines) / elapsed:12.0f} lines/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+""" A local stand-in for the Miso Data API, for benchmarks.
+
+Supports the upload, `_ids` and `_delete` endpoints of products, users and interactions,
+gzip request bodies, and injected latency, 429 responses and 422 errors.
+
+    python benchmarks/fake_miso.py --port 8080 --latency 0.05 --rate-429 0.01
+"""
+import argparse
+import gzip
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ID_FIELDS = {'products': 'product_id', 'users': 'user_id'}
+
+
+class FakeMiso:
+    """ The state of the fake API, shared by the request handlers """
+
+    def __init__(self, latency: float = 0, rate_429: float = 0, rate_422: float = 0, seed: int = 0):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.rate_422 = rate_422
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = defaultdict(set)
+        self.requests = Counter()
+        self.records = Counter()
+        self.bytes_received = 0
+
+    def roll(self, rate: float) -> bool:
+        with self.lock:
+            return rate > 0 and self.random.random() < rate
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = 'FakeMiso/1.0'
+
+    @property
+    def miso(self) -> FakeMiso:
+        return self.server.miso
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: dict, headers: dict = None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_body(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.miso.lock:
+            self.miso.bytes_received += len(body)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return json.loads(body)
+
+    def _begin(self, endpoint: str) -> bool:
+        """ Count the request, wait, and maybe throttle it """
+        with self.miso.lock:
+            self.miso.requests[f'{self.command} {endpoint}'] += 1
+        if self.miso.latency:
+            time.sleep(self.miso.latency)
+        if self.miso.roll(self.miso.rate_429):
+            with self.miso.lock:
+                self.miso.requests['429'] += 1
+            self._reply(429, {'message': 'Too many requests'}, {'Retry-After': '1'})
+            return False
+        return True
+
+    def do_GET(self):
+        match = re.match(r'/v1/(\w+)/_ids', self.path)
+        if not match:
+            return self._reply(404, {'message': 'Not found'})
+        data_type = match.group(1)
+        if not self._begin(f'{data_type}/_ids'):
+            return
+        with self.miso.lock:
+            ids = sorted(self.miso.ids[data_type])
+        self._reply(200, {'message': 'success', 'data': {'ids': ids}})
+
+    def do_POST(self):
+        match = re.match(r'/v1/(\w+)(/_delete)?\?', self.path)
+        if not match:
+            return self._reply(404, {'message': 'Not found'})
+        data_type, delete = match.groups()
+        if not self._begin(data_type + (delete or '')):
+            return
+        payload = self._read_body()
+        if delete:
+            ids = payload['data'][ID_FIELDS[data_type] + 's']
+            with self.miso.lock:
+                self.miso.ids[data_type].difference_update(ids)
+            return self._reply(200, {'message': 'success'})
+        records = payload['data']
+        if records and self.miso.roll(self.miso.rate_422):
+            index = self.miso.random.randrange(len(records))
+            return self._reply(422, {'errors': True, 'message': f'data.{index}.title: Invalid value'})
+        with self.miso.lock:
+            self.miso.records[data_type] += len(records)
+            if data_type in ID_FIELDS:
+                self.miso.ids[data_type].update(r[ID_FIELDS[data_type]] for r in records)
+        self._reply(200, {'message': 'success', 'data': {'took': 1}})
+
+
+def start_server(miso: FakeMiso, port: int = 0) -> ThreadingHTTPServer:
+    """ Serve the fake API in a daemon thread, port 0 picks a free port """
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.miso = miso
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every request')
+    parser.add_argument('--rate-429', type=float, default=0, help='fraction of requests answered with 429')
+    parser.add_argument('--rate-422', type=float, default=0, help='fraction of batches answered with 422')
+    args = parser.parse_args()
+    miso = FakeMiso(args.latency, args.rate_429, args.rate_422)
+    server = start_server(miso, args.port)
+    print(f'Fake Miso API on http://127.0.0.1:{server.server_address[1]}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print(dict(miso.requests))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+""" End-to-end benchmark of target-miso against a local stand-in of the Miso Data API.
+
+Generates a synthetic singer stream, runs the target on it, and reports records per second,
+peak RSS and the requests the API received. The target logs go to stderr.
+
+    pip install -e .
+    python benchmarks/run_benchmark.py --products 20000 --users 5000 --interactions 100000 \\
+        --latency 0.02 --rate-429 0.01 --config max_in_flight=4 --config payload_encoding=gzip
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fake_miso import FakeMiso, start_server  # noqa: E402
+from synthetic_stream import generate, write_templates  # noqa: E402
+
+
+def parse_config_value(value: str):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def run_in_process(config_path: Path, stream_path: Path):
+    """ Run target_miso.target.main in this process, like the entry point does """
+    from target_miso import target
+
+    argv, stdin, stdout = sys.argv, sys.stdin, sys.stdout
+    with stream_path.open('rb') as stream, open(os.devnull, 'w') as devnull:
+        sys.argv = ['target-miso', '--config', str(config_path)]
+        sys.stdin = io.TextIOWrapper(stream, encoding='utf-8')
+        sys.stdout = devnull
+        try:
+            target.main()
+        finally:
+            sys.argv, sys.stdin, sys.stdout = argv, stdin, stdout
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_cli(config_path: Path, stream_path: Path):
+    """ Run the target-miso entry point in a subprocess """
+    with stream_path.open('rb') as stream:
+        subprocess.run([sys.executable, '-c', 'import target_miso; target_miso.main()', '--config', str(config_path)],
+                       stdin=stream, stdout=subprocess.DEVNULL, check=True)
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--interactions', type=int, default=50000)
+    parser.add_argument('--template', choices=('python', 'jsonnet', 'jinja'), default='python')
+    parser.add_argument('--mode', choices=('in-process', 'cli'), default='in-process')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every API request')
+    parser.add_argument('--rate-429', type=float, default=0, help='fraction of API requests throttled')
+    parser.add_argument('--rate-422', type=float, default=0, help='fraction of batches rejected')
+    parser.add_argument('--config', action='append', default=[], metavar='KEY=VALUE',
+                        help='target config, values are parsed as JSON when possible')
+    args = parser.parse_args()
+
+    miso = FakeMiso(args.latency, args.rate_429, args.rate_422)
+    server = start_server(miso)
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        write_templates(folder / 'template', args.template)
+        stream_path = folder / 'stream.jsonl'
+        with stream_path.open('w') as f:
+            for line in generate(args.products, args.users, args.interactions):
+                f.write(line + '\n')
+        config = {'api_server': f'http://127.0.0.1:{server.server_address[1]}', 'api_key': 'benchmark',
+                  'template_folder': str(folder / 'template')}
+        for item in args.config:
+            key, _, value = item.partition('=')
+            config[key] = parse_config_value(value)
+        config_path = folder / 'config.json'
+        config_path.write_text(json.dumps(config))
+
+        start = time.perf_counter()
+        if args.mode == 'cli':
+            peak_rss_kb = run_cli(config_path, stream_path)
+        else:
+            peak_rss_kb = run_in_process(config_path, stream_path)
+        elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    records = args.products + args.users + args.interactions
+    report = {
+        'records': records,
+        'seconds': round(elapsed, 3),
+        'records_per_second': round(records / elapsed),
+        'peak_rss_mb': round(peak_rss_kb / 1024, 1),
+        'records_received': dict(miso.records),
+        'requests': dict(miso.requests),
+        'bytes_received': miso.bytes_received,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
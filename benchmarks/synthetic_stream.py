@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+""" Synthetic singer streams of products, users and interactions, with templates to load them.
+
+    python benchmarks/synthetic_stream.py --products 10000 --users 5000 --interactions 50000 > stream.jsonl
+"""
+import argparse
+import json
+import random
+import sys
+from pathlib import Path
+from typing import Iterator
+
+STREAMS = ('products', 'users', 'interactions')
+
+SCHEMAS = {
+    'products': {'id': 'string', 'name': 'string', 'description': 'string', 'price': 'number',
+                 'category': 'string', 'tags': 'array', 'updated_at': 'string'},
+    'users': {'id': 'string', 'city': 'string', 'country': 'string', 'email': 'string', 'created_at': 'string'},
+    'interactions': {'user_id': 'string', 'product_id': 'string', 'event': 'string', 'timestamp': 'string'},
+}
+
+TEMPLATES = {
+    'python': {
+        'products': '''
+def transform(r):
+    return {"product_id": r["id"], "title": r["name"], "description": r["description"],
+            "sale_price": r["price"], "categories": [[r["category"]]], "tags": r["tags"],
+            "updated_at": r["updated_at"]}
+''',
+        'users': '''
+def transform(r):
+    return {"user_id": r["id"], "city": r["city"], "country": r["country"],
+            "custom_attributes": {"email": r["email"]}, "created_at": r["created_at"]}
+''',
+        'interactions': '''
+def transform(r):
+    return {"type": r["event"], "user_id": r["user_id"], "product_ids": [r["product_id"]],
+            "timestamp": r["timestamp"]}
+''',
+    },
+    'jsonnet': {
+        'products': '''{product_id: data.id, title: data.name, description: data.description, sale_price: data.price,
+ categories: [[data.category]], tags: data.tags, updated_at: data.updated_at}''',
+        'users': '''{user_id: data.id, city: data.city, country: data.country,
+ custom_attributes: {email: data.email}, created_at: data.created_at}''',
+        'interactions': '''{type: data.event, user_id: data.user_id, product_ids: [data.product_id],
+ timestamp: data.timestamp}''',
+    },
+    'jinja': {
+        'products': '''{"product_id": {{ data.id | jsonify }}, "title": {{ data.name | jsonify }},
+ "description": {{ data.description | jsonify }}, "sale_price": {{ data.price }},
+ "categories": {{ data.category | convert_categories | jsonify }}, "tags": {{ data.tags | jsonify }},
+ "updated_at": "{{ data.updated_at | datetime_format }}"}''',
+        'users': '''{"user_id": {{ data.id | jsonify }}, "city": {{ data.city | jsonify }},
+ "country": {{ data.country | jsonify }}, "custom_attributes": {"email": {{ data.email | jsonify }}},
+ "created_at": "{{ data.created_at | datetime_format }}"}''',
+        'interactions': '''{"type": {{ data.event | jsonify }}, "user_id": {{ data.user_id | jsonify }},
+ "product_ids": [{{ data.product_id | jsonify }}], "timestamp": "{{ data.timestamp | datetime_format }}"}''',
+    },
+}
+
+TEMPLATE_SUFFIXES = {'python': '.py', 'jsonnet': '.jsonnet', 'jinja': '.jinja'}
+
+
+def write_templates(folder: Path, kind: str):
+    """ Write the templates of the synthetic streams """
+    folder.mkdir(parents=True, exist_ok=True)
+    for stream, template in TEMPLATES[kind].items():
+        (folder / f'{stream}{TEMPLATE_SUFFIXES[kind]}').write_text(template)
+
+
+def _message(**kwargs) -> str:
+    return json.dumps(kwargs)
+
+
+def _schema(stream: str, key: str) -> str:
+    properties = {name: {'type': [kind, 'null']} for name, kind in SCHEMAS[stream].items()}
+    return _message(type='SCHEMA', stream=stream, schema={'type': 'object', 'properties': properties},
+                    key_properties=[key])
+
+
+def generate(products: int = 1000, users: int = 1000, interactions: int = 10000,
+             state_every: int = 1000, seed: int = 0) -> Iterator[str]:
+    """ Singer messages of a full sync: schemas, records, states, and ACTIVATE_VERSION per stream """
+    rand = random.Random(seed)
+    version = 1
+    count = 0
+
+    def state(stream, position):
+        return _message(type='STATE', value={'bookmarks': {stream: {'position': position}}})
+
+    yield _schema('products', 'id')
+    yield _message(type='ACTIVATE_VERSION', stream='products', version=version)
+    for i in range(products):
+        yield _message(type='RECORD', stream='products', version=version, record={
+            'id': f'P{i:08d}', 'name': f'Product {i}',
+            'description': ' '.join(rand.choice(('soft', 'blue', 'steel', 'eco', 'large', 'classic'))
+                                    for _ in range(40)),
+            'price': round(rand.uniform(1, 500), 2), 'category': rand.choice(('Home', 'Garden', 'Toys')),
+            'tags': rand.sample(('new', 'sale', 'gift', 'limited', 'bundle'), 2),
+            'updated_at': f'2022-{1 + i % 12:02d}-{1 + i % 28:02d}T10:00:00Z'})
+        count += 1
+        if count % state_every == 0:
+            yield state('products', i)
+    yield _message(type='ACTIVATE_VERSION', stream='products', version=version)
+
+    yield _schema('users', 'id')
+    yield _message(type='ACTIVATE_VERSION', stream='users', version=version)
+    for i in range(users):
+        yield _message(type='RECORD', stream='users', version=version, record={
+            'id': f'U{i:08d}', 'city': rand.choice(('Taipei', 'Berlin', 'Austin')),
+            'country': rand.choice(('TW', 'DE', 'US')), 'email': f'user{i}@example.com',
+            'created_at': f'2021-{1 + i % 12:02d}-{1 + i % 28:02d}T08:30:00+00:00'})
+        count += 1
+        if count % state_every == 0:
+            yield state('users', i)
+    yield _message(type='ACTIVATE_VERSION', stream='users', version=version)
+
+    yield _schema('interactions', 'user_id')
+    for i in range(interactions):
+        yield _message(type='RECORD', stream='interactions', record={
+            'user_id': f'U{rand.randrange(max(users, 1)):08d}',
+            'product_id': f'P{rand.randrange(max(products, 1)):08d}',
+            'event': rand.choice(('product_detail_page_view', 'add_to_cart', 'checkout')),
+            'timestamp': f'2022-03-{1 + i % 28:02d}T{i % 24:02d}:{i % 60:02d}:00Z'})
+        count += 1
+        if count % state_every == 0:
+            yield state('interactions', i)
+    yield state('interactions', interactions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--interactions', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for line in generate(args.products, args.users, args.interactions, seed=args.seed):
+        sys.stdout.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
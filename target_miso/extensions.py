@@ -1,19 +1,77 @@
+import datetime
 import json
-from typing import Optional
+import re
+from functools import lru_cache, wraps
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
 from urllib.parse import urlparse, quote
 
-import dateparser
 import pytz
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 
+# values remembered by each memoized filter
+FILTER_CACHE_SIZE = 4096
 
+ISO_DATETIME = re.compile(r'(\d{4})([-/])(\d{2})\2(\d{2})'
+                          r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.\d{1,6})?)?)?'
+                          r'\s*(Z|[+-]\d{2}:?\d{2})?$')
+
+REMOVED_SYMBOLS = str.maketrans('', '', '"\\“')
+
+
+def memoize(func):
+    """ Remember the results of a filter for hashable values """
+    cached = lru_cache(maxsize=FILTER_CACHE_SIZE, typed=True)(func)
+
+    @wraps(func)
+    def wrapper(value):
+        try:
+            hash(value)
+        except TypeError:
+            # unhashable value
+            return func(value)
+        return cached(value)
+    wrapper.cache_info = cached.cache_info
+    wrapper.cache_clear = cached.cache_clear
+    return wrapper
+
+
+@memoize
 def fix_url(value: str) -> str:
     url = urlparse(value)
     return url._replace(path=quote(url.path)).geturl()
 
 
+def parse_iso_datetime(value: str) -> Optional[datetime.datetime]:
+    """ Parse ISO-8601 like dates without dateparser, None if the format is not recognized """
+    match = ISO_DATETIME.match(value.strip())
+    if not match:
+        return None
+    year, _, month, day, hour, minute, second, offset = match.groups()
+    try:
+        dt = datetime.datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0))
+        if offset == 'Z':
+            dt = dt.replace(tzinfo=pytz.UTC)
+        elif offset:
+            offset = offset.replace(':', '')
+            minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+            if offset[0] == '-':
+                minutes = -minutes
+            dt = dt.replace(tzinfo=datetime.timezone(datetime.timedelta(minutes=minutes)))
+    except ValueError:
+        return None
+    return dt
+
+
+@memoize
 def datetime_format(value: str) -> str:
-    dt = dateparser.parse(value)
+    dt = None
+    if isinstance(value, str):
+        dt = parse_iso_datetime(value)
+    if dt is None:
+        # slow to import, only loaded for dates which are not ISO-8601
+        import dateparser
+        dt = dateparser.parse(value)
     if dt.tzinfo is None:
         dt = dt.replace(tzinfo=pytz.UTC)
     dt = dt.replace(microsecond=0)
@@ -42,28 +100,114 @@ def str_to_list_of_str(value: Optional[str]) -> Optional[list]:
     return [str(value)]
 
 
+@memoize
 def remove_symbol(value: Optional[str]) -> str:
     if not value:
         return ''
     if isinstance(value, int):
         return str(value)
-    value = str(value).replace('"', '')
-    value = value.replace("\\", '')
-    value = value.replace("\\\\N", '')
-    value = value.replace("“", '')
-    value = value.replace("\r\n", '')
-    value = value.replace("\n", '')
-    value = value.replace(r'\r', '')
+    # the backslashes are gone before `\\N` and `\r` could match, only `\r\n` and `\n` are left
+    value = str(value).translate(REMOVED_SYMBOLS)
+    if '\n' in value:
+        value = value.replace("\r\n", '').replace("\n", '')
     return value
 
 
-def get_jinja_env(folder_path):
-    env = Environment(loader=FileSystemLoader(folder_path), trim_blocks=True)
-    env.filters['datetime_format'] = datetime_format
-    env.filters['list_of_str'] = str_to_list_of_str
-    env.filters['convert_categories'] = str_to_categories
-    env.filters['remove_symbol'] = remove_symbol
-    env.filters['split'] = str_split_with_comma
-    env.filters['fix_url'] = fix_url
-    env.filters['jsonify'] = json.dumps
+BUILTIN_FILTERS = {
+    'datetime_format': datetime_format,
+    'list_of_str': str_to_list_of_str,
+    'convert_categories': str_to_categories,
+    'remove_symbol': remove_symbol,
+    'split': str_split_with_comma,
+    'fix_url': fix_url,
+    'jsonify': json.dumps,
+}
+
+
+def get_jinja_env(folder_path, cache_folder=None):
+    """ The jinja environment of a template folder, compiled templates are kept in `cache_folder` if set """
+    bytecode_cache = None
+    if cache_folder:
+        Path(cache_folder).mkdir(parents=True, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(str(cache_folder))
+    env = Environment(loader=FileSystemLoader(folder_path), trim_blocks=True, bytecode_cache=bytecode_cache)
+    env.filters.update(BUILTIN_FILTERS)
     return env
+
+
+# `data.a.b['c'][0] | filter | filter`, evaluated without jinja
+SIMPLE_FIELD = re.compile(r'\s*data((?:\.\w+|\[(?:\'[^\']*\'|"[^"]*"|\d+)\])*)\s*((?:\|\s*\w+\s*)*)$')
+PATH_SEGMENT = re.compile(r'\.(\w+)|\[\'([^\']*)\'\]|\["([^"]*)"\]|\[(\d+)\]')
+
+
+class FieldMapping:
+    """ A template mapping Miso fields to jinja expressions, rendered to Python objects.
+
+    The spec is a JSON object. Every string in it is a jinja expression of `data`, other values
+    are kept as they are. Undefined values become None.
+    """
+
+    def __init__(self, spec: Dict, env: Environment):
+        self.spec = spec
+        self.env = env
+        self._render = self._compile(spec)
+
+    def render_object(self, data: Dict) -> Dict:
+        return self._render(data)
+
+    def _compile(self, node) -> Callable[[Dict], Any]:
+        if isinstance(node, dict):
+            fields = [(key, self._compile(value)) for key, value in node.items()]
+            return lambda data: {key: field(data) for key, field in fields}
+        if isinstance(node, list):
+            items = [self._compile(value) for value in node]
+            return lambda data: [item(data) for item in items]
+        if isinstance(node, str):
+            return self._compile_expression(node)
+        return lambda data: node
+
+    def _compile_expression(self, source: str) -> Callable[[Dict], Any]:
+        match = SIMPLE_FIELD.match(source)
+        if match:
+            path = []
+            for segment in PATH_SEGMENT.finditer(match.group(1)):
+                attr, single_quoted, double_quoted, index = segment.groups()
+                if attr is not None and attr.isdigit():
+                    # jinja reads `data.tags.0` as an index
+                    index = attr
+                if index is not None:
+                    path.append(int(index))
+                else:
+                    path.append(next(key for key in (attr, single_quoted, double_quoted) if key is not None))
+            filter_names = [name.strip() for name in match.group(2).split('|')[1:]]
+            filters = [self.env.filters.get(name) for name in filter_names]
+            # jinja would resolve dict attributes like `items` to methods, and refuses `data.tags.0a`
+            if all(f is not None and f is BUILTIN_FILTERS.get(name) for f, name in zip(filters, filter_names)) \
+                    and not any(isinstance(key, str) and (hasattr(dict, key) or key[:1].isdigit()) for key in path):
+                return self._simple_field(path, filters)
+        expression = self.env.compile_expression(source)
+        return lambda data: expression(data=data)
+
+    @staticmethod
+    def _simple_field(path, filters) -> Callable[[Dict], Any]:
+        def field(data):
+            value = data
+            for key in path:
+                if isinstance(value, dict):
+                    value = value.get(key)
+                elif isinstance(value, list) and isinstance(key, int):
+                    value = value[key] if key < len(value) else None
+                else:
+                    value = None
+                if value is None:
+                    break
+            for func in filters:
+                value = func(value)
+            return value
+        return field
+
+
+def load_field_mapping(path: Path, env: Environment) -> FieldMapping:
+    """ Load a field mapping template from a JSON file """
+    with path.open() as f:
+        return FieldMapping(json.load(f), env)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import itertools
+import queue
+import threading
+from typing import Callable, Dict, Iterable, Iterator, List
+
+import singer
+
+logger = singer.get_logger()
+
+_DONE = object()
+
+
+class Tee:
+    """ Feed the items of an iterable to several consumers, each in its own thread.
+
+    The items are shared, not copied. A consumer may fall up to `max_pending` items behind the
+    fastest one, then the producer waits for it.
+    """
+
+    def __init__(self, consumers: int, max_pending: int = 10000):
+        self.queues = [queue.Queue(max_pending) for _ in range(consumers)]
+        self.failed = threading.Event()
+
+    def _iter_queue(self, index: int) -> Iterator:
+        q = self.queues[index]
+        while True:
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                if self.failed.is_set():
+                    raise RuntimeError('Stopped because another consumer failed')
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        while not self.failed.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self, items: Iterable, consume: Callable[[int, Iterator], object]) -> List:
+        """ Run `consume(index, items)` of each consumer, return their results """
+        results = [None] * len(self.queues)
+        errors = []
+
+        def target(index):
+            try:
+                results[index] = consume(index, self._iter_queue(index))
+            except BaseException as e:
+                errors.append(e)
+                self.failed.set()
+
+        threads = [threading.Thread(target=target, args=(i,), name=f'miso-destination-{i}', daemon=True)
+                   for i in range(len(self.queues))]
+        for thread in threads:
+            thread.start()
+        try:
+            for item in items:
+                for q in self.queues:
+                    if not self._put(q, item):
+                        break
+                if self.failed.is_set():
+                    break
+        finally:
+            for q in self.queues:
+                self._put(q, _DONE)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+
+class CheckpointMerger:
+    """ Emit a STATE checkpoint once every destination has reached it, with the upload state of each """
+
+    def __init__(self, names: List[str], emit: Callable[[Dict], None]):
+        self.names = names
+        self.emit = emit
+        self.lock = threading.Lock()
+        # checkpoint number to the states of the destinations which reached it
+        self.pending: Dict[int, Dict[str, Dict]] = {}
+
+    def emitter(self, name: str) -> Callable[[Dict], None]:
+        """ The emit function of a destination, called with None when the destination holds a checkpoint """
+        sequence = itertools.count()
+
+        def emit(state: Dict):
+            number = next(sequence)
+            with self.lock:
+                states = self.pending.setdefault(number, {})
+                states[name] = state
+                if len(states) == len(self.names):
+                    # the last destination to reach a checkpoint has passed the earlier ones, they are out already
+                    del self.pending[number]
+                    if None not in states.values():
+                        self.emit(merge_states(states.values()))
+        return emit
+
+
+def merge_states(states: Iterable[Dict]) -> Dict:
+    """ The tap state with the upload state of every destination """
+    merged = {}
+    for state in states:
+        merged.update(state)
+    return merged
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+import hashlib
+from typing import Dict, Optional
+
+import simplejson as json
+
+from .miso import json_default
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+FINGERPRINT_ALGORITHMS = ('md5', 'blake2b', 'xxhash')
+
+
+def canonical_json(record: Dict) -> bytes:
+    """ Serialize a record with sorted keys.
+
+    The bytes are the same with or without orjson, except for floats with an exponent
+    (1e-07 with simplejson, 1e-7 with orjson), whose records are uploaded again when orjson
+    is installed or removed.
+    """
+    if orjson is not None:
+        return orjson.dumps(record, default=json_default,
+                            option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(record, default=json_default, use_decimal=False, sort_keys=True,
+                      separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def legacy_md5(record: Dict) -> str:
+    """ The hash stored by earlier versions """
+    return hashlib.md5(json.dumps(record, sort_keys=True).encode()).hexdigest()
+
+
+def fingerprint(record: Dict, algorithm: str = 'blake2b') -> str:
+    """ A short hash of a record, prefixed with the algorithm """
+    if algorithm == 'md5':
+        return legacy_md5(record)
+    if algorithm == 'xxhash':
+        if xxhash is None:
+            raise ValueError('xxhash fingerprint needs the xxhash package')
+        return 'xx:' + xxhash.xxh3_64_hexdigest(canonical_json(record))
+    if algorithm == 'blake2b':
+        return 'b2:' + hashlib.blake2b(canonical_json(record), digest_size=8).hexdigest()
+    raise ValueError(f'fingerprint must be one of {FINGERPRINT_ALGORITHMS}: {algorithm}')
+
+
+def is_same_record(stored_hash: Optional[str], record: Dict, record_hash: str) -> bool:
+    """ Whether the stored hash is of the same record, `record_hash` being its current fingerprint """
+    if stored_hash is None:
+        return False
+    if stored_hash == record_hash:
+        return True
+    if ':' not in stored_hash and ':' in record_hash:
+        # md5 from an earlier version
+        return stored_hash == legacy_md5(record)
+    return False
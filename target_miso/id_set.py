@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import heapq
+import tempfile
+from typing import IO, Iterable, Iterator, List
+
+import simplejson as json
+
+from .memory import estimate_size
+
+# ids kept in memory before a sorted run is spilled to disk
+DEFAULT_MAX_IN_MEMORY = 1000000
+# ids worth a temporary file when memory is released before the limit
+MIN_SPILL = 10000
+
+
+def _unique(ids: Iterator[str]) -> Iterator[str]:
+    """ Drop repeated ids from a sorted iterator """
+    last = None
+    for record_id in ids:
+        if record_id != last:
+            yield record_id
+            last = record_id
+
+
+def _read_run(run: IO) -> Iterator[str]:
+    run.seek(0)
+    for line in run:
+        yield json.loads(line)
+
+
+class IdSet:
+    """ A set of ids which spills sorted runs to temporary files when it grows large.
+
+    Ids are compared as strings. Iteration merges the runs in sorted order, so the
+    difference of two sets is computed in bounded memory.
+    """
+
+    def __init__(self, max_in_memory: int = DEFAULT_MAX_IN_MEMORY):
+        self.max_in_memory = max_in_memory
+        self.ids: List[str] = []
+        self.runs: List[IO] = []
+        self.spilled = 0
+
+    def add(self, record_id):
+        self.ids.append(str(record_id))
+        if len(self.ids) >= self.max_in_memory:
+            self._spill()
+
+    def update(self, record_ids: Iterable):
+        for record_id in record_ids:
+            self.add(record_id)
+
+    def _spill(self):
+        run = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+        for record_id in _unique(iter(sorted(self.ids))):
+            run.write(json.dumps(record_id))
+            run.write('\n')
+        self.spilled += len(self.ids)
+        self.runs.append(run)
+        self.ids = []
+
+    def spill(self, min_ids: int = MIN_SPILL):
+        """ Move the ids in memory to disk, if there are at least `min_ids` of them """
+        if self.ids and len(self.ids) >= min_ids:
+            self._spill()
+
+    def memory_size(self) -> int:
+        """ The approximate size of the ids in memory """
+        return estimate_size(self.ids, self.ids, len(self.ids))
+
+    def __len__(self):
+        """ The number of ids added, including repeated ones """
+        return self.spilled + len(self.ids)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self) -> Iterator[str]:
+        """ Unique ids in sorted order """
+        self.ids.sort()
+        return _unique(heapq.merge(iter(self.ids), *[_read_run(run) for run in self.runs]))
+
+    def difference(self, other: 'IdSet') -> Iterator[str]:
+        """ Ids in this set but not in the other one, in sorted order """
+        others = iter(other)
+        other_id = next(others, None)
+        for record_id in self:
+            while other_id is not None and other_id < record_id:
+                other_id = next(others, None)
+            if record_id != other_id:
+                yield record_id
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.ids = []
+        self.spilled = 0
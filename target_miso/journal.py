@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+import os
+import threading
+from pathlib import Path
+from typing import Dict, IO, Iterator, List, Optional, Tuple
+
+import simplejson as json
+import singer
+
+logger = singer.get_logger()
+
+SEGMENT_SUFFIX = '.segment'
+
+
+class BatchJournal:
+    """ Append-only segment files of the records handed to the writer.
+
+    Each data type appends to an open segment, which is sealed (fsync'ed) when its batch is submitted
+    and removed once the batch is acknowledged by the API. Segments left behind by a run that died
+    are replayed on the next start.
+    """
+
+    def __init__(self, folder: str, fsync: bool = True):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.type_to_segment: Dict[str, Tuple[Path, IO[bytes]]] = {}
+        pending = self.pending()
+        self.sequence = int(pending[-1].name.split('.')[0]) + 1 if pending else 0
+
+    def pending(self) -> List[Path]:
+        """ The segments not acknowledged yet, oldest first """
+        return sorted(self.folder.glob('*' + SEGMENT_SUFFIX))
+
+    def _open(self, data_type: str) -> IO[bytes]:
+        with self.lock:
+            path = self.folder / f'{self.sequence:012d}.{data_type}{SEGMENT_SUFFIX}'
+            self.sequence += 1
+        segment = path.open('ab')
+        self.type_to_segment[data_type] = (path, segment)
+        return segment
+
+    def append(self, data_type: str, line: bytes):
+        """ Append a serialized record to the open segment of a data type """
+        segment = self.type_to_segment.get(data_type)
+        (segment[1] if segment else self._open(data_type)).write(line + b'\n')
+
+    def seal(self, data_type: str) -> Optional[Path]:
+        """ Close the open segment of a data type, return its path """
+        segment = self.type_to_segment.pop(data_type, None)
+        if segment is None:
+            return None
+        path, f = segment
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+        f.close()
+        return path
+
+    @staticmethod
+    def ack(path: Path):
+        """ Drop a segment whose records have been uploaded """
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def read(path: Path) -> Tuple[str, List[Dict]]:
+        """ The data type and the records of a segment """
+        data_type = path.name.split('.')[1]
+        records = []
+        with path.open('rb') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # the last line of a segment which was being written when the process died
+                    logger.warning("Skipped a truncated record in %s", path)
+        return data_type, records
+
+    def replay(self) -> Iterator[Tuple[Path, str, List[Dict]]]:
+        """ The segments of earlier runs with their records """
+        open_paths = {path for path, _ in self.type_to_segment.values()}
+        for path in self.pending():
+            if path not in open_paths:
+                yield (path,) + self.read(path)
+
+    def close(self):
+        """ Seal the open segments, their records are replayed on the next start """
+        for data_type in list(self.type_to_segment):
+            self.seal(data_type)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+import gc
+import itertools
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, Iterable, Optional
+
+import singer
+
+from .metrics import metrics
+
+logger = singer.get_logger()
+
+MB = 1024 * 1024
+
+
+class MemoryLimitExceeded(MemoryError):
+    """ The process went over the hard memory limit """
+
+
+def rss_bytes() -> int:
+    """ The resident set size of the process, its peak where the current value is not available, 0 on Windows """
+    try:
+        import resource
+    except ImportError:
+        return 0
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def deep_sizeof(obj) -> int:
+    """ The size of an object with the strings, lists and dicts it holds """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k) + deep_sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_sizeof(v) for v in obj)
+    return size
+
+
+def estimate_size(container, items: Iterable, count: int, sample: int = 16) -> int:
+    """ The approximate size of a container of `count` items, from the size of a few of them """
+    sizes = [deep_sizeof(item) for item in itertools.islice(items, sample)]
+    if not sizes:
+        return sys.getsizeof(container)
+    return sys.getsizeof(container) + count * sum(sizes) // len(sizes)
+
+
+class MemoryMonitor:
+    """ Watches the memory of the process while messages are written.
+
+    Every `check_every` messages the RSS is read. Every `report_interval` seconds the size of the
+    structures of the writers is logged, with the top allocations when tracemalloc is tracing.
+    Above `limit_mb` the writers are asked to release memory (flush buffers, spill ids), at most
+    every `release_interval` seconds since the RSS seldom goes down afterwards. Above
+    `hard_limit_mb` the run stops with a diagnostic instead of being killed.
+    """
+
+    def __init__(self, report_interval: float = 0, limit_mb: Optional[float] = None,
+                 hard_limit_mb: Optional[float] = None, check_every: int = 1000, release_interval: float = 60):
+        self.report_interval = report_interval
+        self.limit = limit_mb * MB if limit_mb else None
+        self.hard_limit = hard_limit_mb * MB if hard_limit_mb else None
+        self.check_every = check_every
+        self.countdown = check_every
+        self.reported_at = time.monotonic()
+        self.release_interval = release_interval
+        self.released_at = float('-inf')
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.report_interval or self.limit or self.hard_limit)
+
+    def tick(self, sizes: Callable[[], Dict[str, int]], release: Callable[[], None]):
+        """ Called for each message, checks the memory every `check_every` calls """
+        self.countdown -= 1
+        if self.countdown > 0:
+            return
+        self.countdown = self.check_every
+        self.check(sizes, release)
+
+    def check(self, sizes: Callable[[], Dict[str, int]], release: Callable[[], None]):
+        rss = rss_bytes()
+        metrics.peak('memory_rss_bytes', rss)
+        if self.hard_limit and rss > self.hard_limit:
+            diagnostic = self.report(rss, sizes(), level='critical')
+            raise MemoryLimitExceeded(f'RSS {rss / MB:.0f}MB is over the memory limit of '
+                                      f'{self.hard_limit / MB:.0f}MB: {diagnostic}')
+        if self.report_interval and time.monotonic() - self.reported_at >= self.report_interval:
+            self.report(rss, sizes())
+            self.reported_at = time.monotonic()
+        if self.limit and rss > self.limit and time.monotonic() - self.released_at >= self.release_interval:
+            logger.warning('RSS %.0fMB is over %.0fMB, flush buffers and spill ids', rss / MB, self.limit / MB)
+            metrics.incr('memory_releases')
+            release()
+            gc.collect()
+            self.released_at = time.monotonic()
+
+    def report(self, rss: int, sizes: Dict[str, int], level: str = 'info') -> str:
+        """ Log the RSS and the approximate size of each structure, return the message """
+        for name, size in sizes.items():
+            metrics.peak('memory_estimate_bytes', size, structure=name)
+        parts = [f'rss={rss / MB:.1f}MB']
+        parts += [f'{name}={size / MB:.1f}MB' for name, size in sorted(sizes.items(), key=lambda x: -x[1])]
+        if tracemalloc.is_tracing():
+            top = tracemalloc.take_snapshot().statistics('lineno')[:5]
+            parts += [f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}={stat.size / MB:.1f}MB'
+                      for stat in top]
+        message = 'Memory: ' + ' '.join(parts)
+        getattr(logger, level)(message)
+        return message
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+import bisect
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import simplejson as json
+import singer
+
+logger = singer.get_logger()
+
+# upper bounds in seconds of the latency histograms
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, tags: Dict) -> Key:
+    return name, tuple(sorted((k, str(v)) for k, v in tags.items()))
+
+
+class Metrics:
+    """ Thread-safe counters, latency histograms and peak values, tagged by stream or data type """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[Key, float] = defaultdict(float)
+        # key to [count, sum, bucket counts...]
+        self.histograms: Dict[Key, List[float]] = {}
+        self.peaks: Dict[Key, float] = {}
+
+    def incr(self, name: str, value: float = 1, **tags):
+        with self.lock:
+            self.counters[_key(name, tags)] += value
+
+    def observe(self, name: str, seconds: float, **tags):
+        with self.lock:
+            histogram = self.histograms.setdefault(_key(name, tags), [0, 0.0] + [0] * (len(BUCKETS) + 1))
+            histogram[0] += 1
+            histogram[1] += seconds
+            histogram[2 + bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def peak(self, name: str, value: float, **tags):
+        key = _key(name, tags)
+        with self.lock:
+            if value > self.peaks.get(key, float('-inf')):
+                self.peaks[key] = value
+
+    @contextmanager
+    def timer(self, name: str, **tags):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **tags)
+
+    def get(self, name: str, **tags) -> float:
+        """ The value of a counter """
+        return self.counters.get(_key(name, tags), 0)
+
+    def drain(self) -> Dict:
+        """ Take the collected values and reset, to send them to another process """
+        with self.lock:
+            data = {'counters': dict(self.counters), 'histograms': self.histograms, 'peaks': self.peaks}
+            self.counters = defaultdict(float)
+            self.histograms = {}
+            self.peaks = {}
+        return data
+
+    def merge(self, data: Dict):
+        """ Add the values drained from another process """
+        with self.lock:
+            for key, value in data['counters'].items():
+                self.counters[key] += value
+            for key, values in data['histograms'].items():
+                histogram = self.histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    histogram[i] += value
+            for key, value in data['peaks'].items():
+                if value > self.peaks.get(key, float('-inf')):
+                    self.peaks[key] = value
+
+    def reset(self):
+        self.drain()
+
+    def summary(self) -> List[Dict]:
+        """ The metrics as singer METRIC points """
+        with self.lock:
+            points = [{'type': 'counter', 'metric': name, 'value': value, 'tags': dict(tags)}
+                      for (name, tags), value in sorted(self.counters.items())]
+            points += [{'type': 'timer', 'metric': name, 'value': round(values[1], 6),
+                        'tags': dict(tags, count=values[0])}
+                       for (name, tags), values in sorted(self.histograms.items())]
+            points += [{'type': 'gauge', 'metric': name, 'value': value, 'tags': dict(tags)}
+                       for (name, tags), value in sorted(self.peaks.items())]
+        return points
+
+    def log(self):
+        """ Log the metrics like singer-python does """
+        for point in self.summary():
+            logger.info('METRIC: %s', json.dumps(point))
+
+    def to_prometheus(self) -> str:
+        """ The metrics in the Prometheus text format """
+        def labels(tags, **extra):
+            pairs = list(tags) + sorted(extra.items())
+            if not pairs:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in pairs) + '}'
+
+        lines = []
+        typed = set()
+
+        def declare(metric, metric_type):
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f'# TYPE {metric} {metric_type}')
+
+        with self.lock:
+            for (name, tags), value in sorted(self.counters.items()):
+                declare(f'target_miso_{name}_total', 'counter')
+                lines.append(f'target_miso_{name}_total{labels(tags)} {value}')
+            for (name, tags), values in sorted(self.histograms.items()):
+                declare(f'target_miso_{name}_seconds', 'histogram')
+                cumulative = 0
+                for bound, count in zip(list(BUCKETS) + ['+Inf'], values[2:]):
+                    cumulative += count
+                    lines.append(f'target_miso_{name}_seconds_bucket{labels(tags, le=bound)} {cumulative}')
+                lines.append(f'target_miso_{name}_seconds_sum{labels(tags)} {values[1]}')
+                lines.append(f'target_miso_{name}_seconds_count{labels(tags)} {values[0]}')
+            for (name, tags), value in sorted(self.peaks.items()):
+                declare(f'target_miso_{name}', 'gauge')
+                lines.append(f'target_miso_{name}{labels(tags)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        """ Write a textfile for the node exporter, replaced atomically """
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def emit(self, prometheus_file: Optional[str] = None):
+        self.log()
+        if prometheus_file:
+            self.write_prometheus(prometheus_file)
+
+
+# metrics of this process
+metrics = Metrics()
@@ -1,15 +1,36 @@
 #!/usr/bin/env python3
-from typing import List, Dict, Set
+import codecs
+import datetime
+import threading
+import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+from decimal import Decimal
+from pathlib import Path
+from typing import List, Dict, Optional, Iterable, Iterator, Tuple, NamedTuple
 
 import re
 import requests
+import simplejson as json
 import singer
 from requests import HTTPError
 from requests.adapters import HTTPAdapter
-from urllib3 import Retry
+
+from .journal import BatchJournal
+from .memory import estimate_size
+from .metrics import metrics
+from .rate_limit import AdaptiveRateLimiter, RetryBudget, RETRY_STATUSES, parse_retry_after
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = singer.get_logger()
 
+PAYLOAD_ENCODINGS = ('json', 'stream', 'gzip')
+
 
 def check_miso_data_type(record):
     """ Determine data type """
@@ -23,91 +44,541 @@ def check_miso_data_type(record):
         raise ValueError(f'This record is not product, user, nor interaction: {record}')
     return data_type
 
+
+ID_FIELDS = {'products': 'product_id', 'users': 'user_id'}
+
+
+def coalesce(records: List[Dict], data_type: str) -> List[Dict]:
+    """ Keep the last version of each product or user, where its first version was """
+    id_field = ID_FIELDS.get(data_type)
+    if id_field is None:
+        return records
+    id_to_index = {}
+    result = []
+    for record in records:
+        index = id_to_index.get(record.get(id_field))
+        if index is None:
+            id_to_index[record.get(id_field)] = len(result)
+            result.append(record)
+        else:
+            result[index] = record
+    return result
+
+
 def find_erroneous_record(res_text):
     return sorted(set([int(x) for x in re.findall('data\.(\d+)\.', res_text)]))
 
+
+IDS_ARRAY_START = re.compile(r'"ids"\s*:\s*\[')
+
+
+def iter_ids(chunks: Iterable[bytes]) -> Iterator[str]:
+    """ Incrementally parse the `ids` array of an _ids API response body """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    json_decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ''
+    pos = None
+    while True:
+        chunk = next(chunks, None)
+        buffer += decoder.decode(chunk or b'', final=chunk is None)
+        if pos is None:
+            match = IDS_ARRAY_START.search(buffer)
+            if match:
+                pos = match.end()
+            elif chunk is None:
+                raise ValueError('No ids in the response')
+            else:
+                continue
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                record_id, end = json_decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # the id is cut at the end of the chunk
+                break
+            if end == len(buffer) and chunk is not None:
+                # a number may go on in the next chunk
+                break
+            yield record_id
+            pos = end
+        if chunk is None:
+            raise ValueError('Truncated ids in the response')
+        # drop what has been parsed
+        buffer = buffer[pos:]
+        pos = 0
+
+
+def json_default(obj):
+    """ Serialize what JSON doesn't support: decimals as numbers, anything else as a string """
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    return str(obj)
+
+
+def encode_record(record: Dict) -> bytes:
+    """ Serialize a record to JSON, with orjson if it is installed """
+    if orjson is not None:
+        return orjson.dumps(record, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(record, default=json_default, use_decimal=False).encode()
+
+
+def iter_payload(data: List[Dict]) -> Iterator[bytes]:
+    """ Write the request body of a batch piece by piece """
+    yield b'{"data":['
+    for i, record in enumerate(data):
+        if i:
+            yield b','
+        yield encode_record(record)
+    yield b']}'
+
+
+def encode_payload(data: List[Dict], compress: bool) -> Tuple[bytes, int]:
+    """ Encode the request body of a batch, return the body and its uncompressed size """
+    raw_size = 0
+    if compress:
+        # gzip the chunks as they are written, the full JSON text is never held in memory
+        compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+        parts = []
+        for chunk in iter_payload(data):
+            raw_size += len(chunk)
+            parts.append(compressor.compress(chunk))
+        parts.append(compressor.flush())
+        return b''.join(parts), raw_size
+    body = b''.join(iter_payload(data))
+    return body, len(body)
+
+
+class BatchLimit(NamedTuple):
+    """ When a buffer is sent: any of the limits triggers a flush """
+    max_records: int
+    # estimated size of the serialized records
+    max_bytes: Optional[int] = None
+    # seconds since the first record entered the buffer
+    max_age: Optional[float] = None
+
+
+class DeadLetterFile:
+    """ JSON lines of the records the API rejected, with the error """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+
+    def write(self, data_type: str, records: List[Dict], error: str):
+        rejected_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        lines = [encode_record({'data_type': data_type, 'error': error, 'rejected_at': rejected_at, 'record': record})
+                 for record in records]
+        with self.lock, self.path.open('ab') as f:
+            f.write(b'\n'.join(lines) + b'\n')
+
+
 class MisoWriter:
-    def __init__(self, api_server: str, api_key: str, use_async: bool, dry_run: bool, write_record_limit: int = 100):
+    def __init__(self, api_server: str, api_key: str, use_async: bool, dry_run: bool = False,
+                 write_record_limit: int = 100, max_in_flight: int = 1, payload_encoding: str = 'json',
+                 batch_limits: Optional[Dict[str, BatchLimit]] = None,
+                 delete_chunk_size: int = 1000, delete_retries: int = 3,
+                 journal: Optional[BatchJournal] = None, max_retries: int = 3, backoff_factor: float = 1,
+                 retry_budget: Optional[RetryBudget] = None, rate_limit: Optional[Dict] = None,
+                 dead_letter: Optional[DeadLetterFile] = None, coalesce_records: bool = True):
+        if payload_encoding not in PAYLOAD_ENCODINGS:
+            raise ValueError(f'payload_encoding must be one of {PAYLOAD_ENCODINGS}: {payload_encoding}')
         self.type_to_buffer = {'products': [], 'interactions': [], 'users': []}
+        self.type_to_limit: Dict[str, BatchLimit] = {
+            'products': BatchLimit(write_record_limit),
+            'users': BatchLimit(write_record_limit),
+            'interactions': BatchLimit(1000),
+        }
+        self.type_to_limit.update(batch_limits or {})
+        # estimated bytes and the time of the first record of each buffer
+        self.type_to_buffer_bytes: Dict[str, int] = defaultdict(int)
+        self.type_to_buffer_since: Dict[str, float] = {}
+        # positions of the products and users in their buffer, a newer version replaces the buffered one
+        self.coalesce_records = coalesce_records
+        self.type_to_buffer_index: Dict[str, Dict[str, int]] = defaultdict(dict)
+        # estimated bytes of each of these records, taken off the buffer bytes when it is replaced
+        self.type_to_buffer_record_bytes: Dict[str, List[int]] = defaultdict(list)
+        # concurrent uploads: one bounded worker pool per data type
+        self.max_in_flight = max(1, max_in_flight)
+        self.type_to_executor: Dict[str, ThreadPoolExecutor] = {}
+        self.type_to_semaphore: Dict[str, threading.BoundedSemaphore] = {}
+        self.type_to_futures: Dict[str, List[Future]] = defaultdict(list)
+        # product or user id to the in-flight batch holding its last version
+        self.type_to_id_futures: Dict[str, Dict[str, Future]] = defaultdict(dict)
 
-        retry_strategy = Retry(
-            total=3,
-            status_forcelist=[401, 429, 500, 502, 503, 504, 403],
-            allowed_methods=["HEAD", "GET", "OPTIONS", "POST"],
-            backoff_factor=1,
-        )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
+        # retries are made by _request, paced by the rate limiter of each endpoint
+        adapter = HTTPAdapter(pool_maxsize=max(10, self.max_in_flight * len(self.type_to_buffer)))
         self.session: requests.Session = requests.Session()
         self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
         self.api_server = api_server
         self.api_key = api_key
         self.use_async = use_async
         self.dry_run = dry_run
         self.write_record_limit = write_record_limit
+        self.payload_encoding = payload_encoding
+        self.delete_chunk_size = delete_chunk_size
+        self.delete_retries = delete_retries
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.retry_budget = retry_budget or RetryBudget()
+        self.rate_limit = rate_limit or {}
+        self.endpoint_to_limiter: Dict[str, AdaptiveRateLimiter] = {}
+        self._limiter_lock = threading.Lock()
+        # records are journaled to disk until their batch is acknowledged
+        self.journal = journal
+        # where the records rejected by the API go
+        self.dead_letter = dead_letter
+        # batches which failed for a reason that may go away, their records are lost without a journal
+        self.failed_batches = 0
+        self._failed_batches_lock = threading.Lock()
+        # data type to [requests, uncompressed bytes, bytes sent]
+        self.type_to_payload_size: Dict[str, List[int]] = defaultdict(lambda: [0, 0, 0])
+        self._payload_size_lock = threading.Lock()
+
+    def rate_limiter(self, endpoint: str) -> AdaptiveRateLimiter:
+        with self._limiter_lock:
+            if endpoint not in self.endpoint_to_limiter:
+                self.endpoint_to_limiter[endpoint] = AdaptiveRateLimiter(**self.rate_limit)
+            return self.endpoint_to_limiter[endpoint]
+
+    def _request(self, method: str, endpoint: str, url: str, max_retries: Optional[int] = None,
+                 **kwargs) -> requests.Response:
+        """ Send a request paced by the rate limiter of the endpoint, retry throttling, server and
+        connection errors within the retry budget. The last response is returned whatever its status. """
+        limiter = self.rate_limiter(endpoint)
+        max_retries = self.max_retries if max_retries is None else max_retries
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            limiter.acquire()
+            start = time.perf_counter()
+            error = response = None
+            try:
+                response = getattr(self.session, method)(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if error is None and response.status_code not in RETRY_STATUSES:
+                if response.ok:
+                    limiter.on_success(time.perf_counter() - start)
+                return response
+            retry_after = parse_retry_after(response.headers.get('Retry-After')) if response is not None else None
+            limiter.on_throttle(retry_after)
+            if attempt >= max_retries or not self.retry_budget.withdraw():
+                if error is not None:
+                    raise error
+                return response
+            attempt += 1
+            logger.warning("%s from %s, retry %s/%s", error or response.status_code, endpoint, attempt, max_retries)
+            metrics.incr('http_retries', endpoint=endpoint)
+            if response is not None:
+                response.close()
+            if retry_after is None:
+                # the limiter waits out Retry-After by itself
+                time.sleep(self.backoff_factor * 2 ** (attempt - 1))
 
-    def _send_request(self, data: List[Dict], data_type: str):
+    def _post_data(self, url: str, data: List[Dict], data_type: str) -> requests.Response:
+        """ Post a batch with the configured payload encoding """
+        if self.payload_encoding == 'json':
+            response = self._request('post', data_type, url, json={'data': data})
+            body = getattr(response.request, 'body', None)
+            raw_size = sent_size = len(body) if isinstance(body, bytes) else 0
+        else:
+            compress = self.payload_encoding == 'gzip'
+            body, raw_size = encode_payload(data, compress)
+            sent_size = len(body)
+            headers = {'Content-Type': 'application/json'}
+            if compress:
+                headers['Content-Encoding'] = 'gzip'
+            response = self._request('post', data_type, url, data=body, headers=headers)
+        self.record_payload_size(data_type, raw_size, sent_size)
+        logger.info("sent %s %s records: %s bytes, %s bytes on the wire.",
+                    len(data), data_type, raw_size, sent_size)
+        return response
+
+    def record_payload_size(self, data_type: str, raw_size: int, sent_size: int):
+        """ Count the size of a request body """
+        with self._payload_size_lock:
+            sizes = self.type_to_payload_size[data_type]
+            sizes[0] += 1
+            sizes[1] += raw_size
+            sizes[2] += sent_size
+        metrics.incr('bytes_uncompressed', raw_size, data_type=data_type)
+        metrics.incr('bytes_sent', sent_size, data_type=data_type)
+
+    def _send_request(self, data: List[Dict], data_type: str, segment: Optional[Path] = None):
         logger.info("try to send %s requests to %s-data-api, async:%s.",
                     len(data), data_type, self.use_async)
+        if not self._upload(data, data_type):
+            with self._failed_batches_lock:
+                self.failed_batches += 1
+        elif segment is not None:
+            self.journal.ack(segment)
+
+    def _upload(self, data: List[Dict], data_type: str) -> bool:
+        """ Upload a batch, split around the records the API rejects.
+        Return False when some records failed for a reason that may go away, like a server error """
         try:
-            response = self.session.post(
-                '{}/v1/{}?api_key={}{}{}'.format(self.api_server, data_type, self.api_key,
-                                                 "&dry_run=1" if self.dry_run else "",
-                                                 "&async=1" if not self.dry_run and self.use_async else ""),
-                json={'data': list(data)}
-            )
+            with metrics.timer('http_request', endpoint=data_type):
+                response = self._post_data(
+                    '{}/v1/{}?api_key={}{}{}'.format(self.api_server, data_type, self.api_key,
+                                                     "&dry_run=1" if self.dry_run else "",
+                                                     "&async=1" if not self.dry_run and self.use_async else ""),
+                    data, data_type
+                )
             response.raise_for_status()
-            logger.info(response.text)
+            metrics.incr('records_uploaded', len(data), data_type=data_type)
+            logger.debug(response.text)
+            return True
         except HTTPError as error:
-            if error.response.status_code == 422:
-                data_len = len(data)
-                for i in find_erroneous_record(error.response.text):
-                    logger.exception("Data record [%i/%i] %s", i, data_len, data[i])
+            if error.response.status_code in (413, 422):
+                return self._split(data, data_type, error.response)
+            metrics.incr('records_failed', len(data), data_type=data_type)
             logger.exception("Response %s", error.response.text)
-        except ConnectionError:
+        except (requests.ConnectionError, requests.Timeout):
+            metrics.incr('records_failed', len(data), data_type=data_type)
             logger.exception('Connection error')
+        return False
+
+    def _split(self, data: List[Dict], data_type: str, response: requests.Response) -> bool:
+        """ Send again a batch rejected as invalid (422) or too large (413): without the records the
+        error points at, or in halves when it doesn't point at any """
+        text = response.text
+        data_len = len(data)
+        bad = [i for i in find_erroneous_record(text) if i < data_len] if response.status_code == 422 else []
+        if bad:
+            for i in bad:
+                logger.error("Data record [%i/%i] %s", i, data_len, data[i])
+            logger.error("Response %s", text)
+            self.reject([data[i] for i in bad], data_type, text)
+            bad = set(bad)
+            rest = [record for i, record in enumerate(data) if i not in bad]
+            return not rest or self._upload(rest, data_type)
+        if data_len == 1:
+            logger.error("Data record %s, response %s", data[0], text)
+            self.reject(data, data_type, text)
+            return True
+        logger.warning("Split a batch of %s %s rejected with %s", data_len, data_type, response.status_code)
+        metrics.incr('batches_split', data_type=data_type)
+        mid = data_len // 2
+        uploaded = self._upload(data[:mid], data_type)
+        return self._upload(data[mid:], data_type) and uploaded
+
+    def reject(self, records: List[Dict], data_type: str, error: str):
+        """ Give up records the API rejected: write them to the dead-letter file """
+        metrics.incr('records_failed', len(records), data_type=data_type)
+        if self.dead_letter is not None:
+            self.dead_letter.write(data_type, records, error)
+
+    def _submit(self, data: List[Dict], data_type: str, segment: Optional[Path] = None):
+        """ Send a batch, in background if concurrent uploads are enabled """
+        if self.max_in_flight <= 1:
+            self._send_request(data, data_type, segment)
+            return
+        if data_type not in self.type_to_executor:
+            self.type_to_executor[data_type] = ThreadPoolExecutor(
+                max_workers=self.max_in_flight, thread_name_prefix=f'miso-{data_type}')
+            self.type_to_semaphore[data_type] = threading.BoundedSemaphore(self.max_in_flight)
+        id_field = ID_FIELDS.get(data_type)
+        if id_field is not None:
+            # versions of an id must land in order, wait for the in-flight batches with an earlier one
+            id_to_future = {record_id: f for record_id, f in self.type_to_id_futures[data_type].items()
+                            if not f.done()}
+            self.type_to_id_futures[data_type] = id_to_future
+            earlier = {id_to_future[record.get(id_field)] for record in data if record.get(id_field) in id_to_future}
+            if earlier:
+                metrics.incr('batches_ordered', data_type=data_type)
+                wait(earlier)
+        semaphore = self.type_to_semaphore[data_type]
+        # backpressure: block the caller until one of the in-flight batches is done
+        semaphore.acquire()
+        try:
+            future = self.type_to_executor[data_type].submit(self._send_request, data, data_type, segment)
+        except Exception:
+            semaphore.release()
+            raise
+        future.add_done_callback(lambda _: semaphore.release())
+        futures = self.type_to_futures[data_type]
+        futures[:] = [f for f in futures if not f.done()]
+        futures.append(future)
+        if id_field is not None:
+            self.type_to_id_futures[data_type].update((record.get(id_field), future) for record in data)
 
-    def get_existing_ids(self, data_type: str):
-        """ Get existing ids from Miso _ids API """
+    def wait(self, data_type: Optional[str] = None):
+        """ Wait for in-flight batches (of a data type, or all of them) to finish """
+        data_types = [data_type] if data_type else list(self.type_to_futures)
+        for dt in data_types:
+            futures = self.type_to_futures.pop(dt, [])
+            self.type_to_id_futures.pop(dt, None)
+            wait(futures)
+            for future in futures:
+                # re-raise unexpected errors from the worker threads
+                future.result()
+
+    def close(self):
+        """ Wait for in-flight batches and stop the worker pools """
+        self.wait()
+        for executor in self.type_to_executor.values():
+            executor.shutdown()
+        self.type_to_executor.clear()
+        self.type_to_semaphore.clear()
+        if self.journal is not None:
+            self.journal.close()
+
+    def replay_journal(self) -> int:
+        """ Upload the batches a previous run journaled but did not get acknowledged, return the record count """
+        if self.journal is None:
+            return 0
+        count = 0
+        for segment, data_type, records in self.journal.replay():
+            logger.info("Replay %s %s records from %s", len(records), data_type, segment.name)
+            metrics.incr('records_replayed', len(records), data_type=data_type)
+            count += len(records)
+            if self.coalesce_records:
+                # the journal has every version of a record buffered
+                records = coalesce(records, data_type)
+            if records:
+                self._submit(records, data_type, segment)
+            else:
+                self.journal.ack(segment)
+        self.wait()
+        return count
+
+    def get_existing_ids(self, data_type: str, chunk_size: int = 65536) -> Iterator[str]:
+        """ Get existing ids from Miso _ids API, yielded while the response is downloaded """
         logger.info("try to get %s ids from Miso.", data_type)
         try:
-            res = self.session.get(
-                '{}/v1/{}/_ids?api_key={}'.format(self.api_server, data_type, self.api_key)
-            )
-            res.raise_for_status()
-            return res.json()['data']['ids']
+            with self._request(
+                'get', f'{data_type}/_ids',
+                '{}/v1/{}/_ids?api_key={}'.format(self.api_server, data_type, self.api_key),
+                stream=True
+            ) as res:
+                res.raise_for_status()
+                count = 0
+                for record_id in iter_ids(res.iter_content(chunk_size)):
+                    count += 1
+                    yield record_id
+                logger.info("got %s %s ids from Miso.", count, data_type)
         except HTTPError as err:
             if err.response.status_code == 404:
-                return []
+                return
             raise
 
-    def delete_records(self, bulk_del_ids: Set[str], data_type: str):
-        if self.dry_run:
-            logger.info("Skipped in dry run mode: send bulk delete %s by ids to miso. Ids: %s", data_type, bulk_del_ids)
-            return
-        """ Delete a list of records from Miso """
-        logger.info("Send bulk delete %s by ids to miso. Ids: %s", data_type, bulk_del_ids)
+    def _delete_chunk(self, ids: List[str], data_type: str):
+        """ Delete a chunk of ids, retrying on errors """
         col_name = 'product_ids'
         if data_type == 'users':
             col_name = 'user_ids'
-        ret = self.session.post(
-            '{}/v1/{}/_delete?api_key={}'.format(self.api_server, data_type, self.api_key),
-            json={"data": {col_name: list(bulk_del_ids)}})
-        logger.info("Receive response from delete %s", data_type)
+        with metrics.timer('http_request', endpoint=f'{data_type}/_delete'):
+            ret = self._request(
+                'post', f'{data_type}/_delete',
+                '{}/v1/{}/_delete?api_key={}'.format(self.api_server, data_type, self.api_key),
+                max_retries=self.delete_retries, json={"data": {col_name: ids}})
         ret.raise_for_status()
 
-    def write_record(self, record: Dict):
-        """ Write record to Miso """
-        data_type = check_miso_data_type(record)
+    def delete_records(self, bulk_del_ids: Iterable[str], data_type: str) -> List[str]:
+        """ Delete records from Miso in chunks, return the ids actually deleted """
+        bulk_del_ids = list(bulk_del_ids)
+        if self.dry_run:
+            logger.info("Skipped in dry run mode: send bulk delete of %s %s to miso.", len(bulk_del_ids), data_type)
+            logger.debug("Ids: %s", bulk_del_ids)
+            return bulk_del_ids
+        # deletes must land after the upserts sent before them
+        self.wait(data_type)
+        chunks = [bulk_del_ids[i:i + self.delete_chunk_size]
+                  for i in range(0, len(bulk_del_ids), self.delete_chunk_size)]
+        logger.info("Send bulk delete of %s %s to miso in %s chunks.", len(bulk_del_ids), data_type, len(chunks))
+        deleted_ids = []
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix=f'miso-delete-{data_type}') \
+                as executor:
+            future_to_chunk = {executor.submit(self._delete_chunk, chunk, data_type): chunk for chunk in chunks}
+            for done, future in enumerate(as_completed(future_to_chunk), 1):
+                chunk = future_to_chunk[future]
+                try:
+                    future.result()
+                    deleted_ids.extend(chunk)
+                    metrics.incr('records_deleted', len(chunk), data_type=data_type)
+                except requests.RequestException:
+                    logger.exception("Failed to delete a chunk of %s %s", len(chunk), data_type)
+                    logger.debug("Ids: %s", chunk)
+                elapsed = time.monotonic() - start
+                logger.info("Deleted %s/%s %s, chunk %s/%s, %.1f ids/s", len(deleted_ids), len(bulk_del_ids),
+                            data_type, done, len(chunks), len(deleted_ids) / elapsed if elapsed else 0)
+        return deleted_ids
+
+    def _flush_buffer(self, data_type: str):
+        """ Hand the buffer of a data type over to the uploader """
+        buffer = self.type_to_buffer[data_type]
+        self.type_to_buffer[data_type] = []
+        self.type_to_buffer_bytes[data_type] = 0
+        self.type_to_buffer_since.pop(data_type, None)
+        self.type_to_buffer_index.pop(data_type, None)
+        self.type_to_buffer_record_bytes.pop(data_type, None)
+        segment = self.journal.seal(data_type) if self.journal is not None else None
+        if buffer:
+            self._submit(buffer, data_type, segment)
+
+    def flush_expired(self):
+        """ Send the buffers which have been waiting longer than their max_age """
+        now = time.monotonic()
+        for data_type, since in list(self.type_to_buffer_since.items()):
+            max_age = self.type_to_limit[data_type].max_age
+            if max_age is not None and now - since >= max_age:
+                self._flush_buffer(data_type)
+
+    def write_record(self, record: Dict, data_type: Optional[str] = None):
+        """ Write record to Miso, `data_type` is found out from the record if not given """
+        data_type = data_type or check_miso_data_type(record)
+        limit = self.type_to_limit[data_type]
+        line = encode_record(record) if limit.max_bytes or self.journal is not None else None
+        record_size = len(line) + 1 if limit.max_bytes else 0
+        coalesce = self.coalesce_records and data_type in ID_FIELDS
+        index = self.type_to_buffer_index[data_type].get(record.get(ID_FIELDS[data_type])) if coalesce else None
+        if index is not None:
+            # a newer version of a buffered record takes its place, and its size
+            self.type_to_buffer[data_type][index] = record
+            record_sizes = self.type_to_buffer_record_bytes[data_type]
+            self.type_to_buffer_bytes[data_type] += record_size - record_sizes[index]
+            record_sizes[index] = record_size
+            if self.journal is not None:
+                self.journal.append(data_type, line)
+            metrics.incr('records_coalesced', data_type=data_type)
+            if limit.max_bytes and self.type_to_buffer_bytes[data_type] > limit.max_bytes:
+                self._flush_buffer(data_type)
+            self.flush_expired()
+            return
+        if limit.max_bytes:
+            # keep the batch below max_bytes, unless a single record is already bigger
+            if self.type_to_buffer[data_type] and \
+                    self.type_to_buffer_bytes[data_type] + record_size > limit.max_bytes:
+                self._flush_buffer(data_type)
+            self.type_to_buffer_bytes[data_type] += record_size
+        if self.journal is not None:
+            self.journal.append(data_type, line)
         buffer = self.type_to_buffer[data_type]
+        if coalesce:
+            self.type_to_buffer_index[data_type][record.get(ID_FIELDS[data_type])] = len(buffer)
+            self.type_to_buffer_record_bytes[data_type].append(record_size)
+        if not buffer:
+            self.type_to_buffer_since[data_type] = time.monotonic()
         buffer.append(record)
-        limit = 1000 if data_type == 'interactions' else self.write_record_limit
-        if len(buffer) >= limit:
-            self._send_request(buffer, data_type)
-            buffer.clear()
+        metrics.incr('records_buffered', data_type=data_type)
+        metrics.peak('buffer_peak', len(buffer), data_type=data_type)
+        if len(buffer) >= limit.max_records:
+            self._flush_buffer(data_type)
+        self.flush_expired()
+
+    def memory_size(self) -> Dict[str, int]:
+        """ The approximate size of the records in each buffer """
+        return {data_type: estimate_size(buffer, buffer, len(buffer))
+                for data_type, buffer in self.type_to_buffer.items() if buffer}
 
     def flush(self):
+        """ Send the remaining records and wait for all in-flight batches """
         for data_type in list(self.type_to_buffer):
-            buf = self.type_to_buffer[data_type]
-            if buf:
-                self._send_request(buf, data_type)
-                buf.clear()
+            self._flush_buffer(data_type)
+        self.wait()
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
-
+import hashlib
+import importlib.util
+import marshal
 from pathlib import Path
-from typing import Callable
+from types import CodeType
+from typing import Callable, Optional, Union
 
 import singer
 
@@ -14,19 +17,52 @@ def import_code(code, name) -> Callable:
        by dynamically importing the given code and optionally adds it
        to sys.modules under the given name.
     """
-    import imp
     try:
-        module = imp.new_module(name)
+        module = importlib.util.module_from_spec(importlib.util.spec_from_loader(name, loader=None))
         exec(code, module.__dict__)
     except:
         logger.exception('Failed to load code from %s', name)
         raise
-    if 'transform' not in module.__dict__:
+    transform = module.__dict__.get('transform')
+    transform_batch = module.__dict__.get('transform_batch')
+    if transform is None and transform_batch is None:
         raise ValueError('There is no transform function in the code')
-    return module.transform
+    if transform is None:
+        def transform(record):
+            return transform_batch([record])[0]
+    if transform_batch is not None:
+        # records of the stream will be transformed in batches
+        transform.transform_batch = transform_batch
+    return transform
+
+
+def get_transform_batch(func: Callable) -> Optional[Callable]:
+    """ The transform_batch function loaded along with a transform function, if any """
+    return getattr(func, 'transform_batch', None)
+
+
+def compile_code(source: str, path: Path, cache_folder: Optional[Union[str, Path]] = None) -> CodeType:
+    """ Compile the code of a file, cached in `cache_folder` by the hash of the code """
+    if not cache_folder:
+        return compile(source, str(path), 'exec')
+    key = hashlib.sha256(importlib.util.MAGIC_NUMBER + str(path).encode() + b'\0' + source.encode()).hexdigest()
+    cache_path = Path(cache_folder) / f'{key}.pyc'
+    try:
+        return marshal.loads(cache_path.read_bytes())
+    except (OSError, ValueError, EOFError, TypeError):
+        pass
+    code = compile(source, str(path), 'exec')
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(f'.{id(code)}.tmp')
+        tmp_path.write_bytes(marshal.dumps(code))
+        tmp_path.replace(cache_path)
+    except OSError:
+        logger.warning('Failed to cache the code of %s in %s', path, cache_folder)
+    return code
 
 
-def import_code_path(path: Path) -> Callable:
+def import_code_path(path: Path, cache_folder: Optional[Union[str, Path]] = None) -> Callable:
     """ import code in a file """
     name = path.stem.replace('-', '_').replace('/', '_').replace('.', '_')
-    return import_code(path.open().read(), name)
+    return import_code(compile_code(path.read_text(), path, cache_folder), name)
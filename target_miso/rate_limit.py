@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+# responses worth another try: throttling and server errors, never authentication failures
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """ Seconds to wait from a Retry-After header, in seconds or as an HTTP date """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveRateLimiter:
+    """ Paces the requests of an endpoint, adapted to the server feedback with AIMD.
+
+    The rate grows by `increase` requests per second every second of successful requests, and is
+    multiplied by `decrease` when the API throttles, fails, or answers slower than `target_latency`.
+    With no `initial_rate` requests start at `max_rate`, or are not paced until the first throttle
+    when there is no `max_rate` either, which starts from the rate observed so far.
+    """
+
+    def __init__(self, initial_rate: Optional[float] = None, max_rate: Optional[float] = None,
+                 min_rate: float = 0.5, increase: float = 1.0, decrease: float = 0.5,
+                 target_latency: Optional[float] = None):
+        self.lock = threading.Lock()
+        self.rate = initial_rate if initial_rate is not None else max_rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.next_time = 0.0
+        self.paused_until = 0.0
+        self.decreased_at = float('-inf')
+        self.sent = deque(maxlen=32)
+
+    def acquire(self):
+        """ Wait for the next slot of this endpoint """
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.paused_until)
+            if self.rate is not None:
+                start = max(start, self.next_time)
+                self.next_time = start + 1 / self.rate
+            self.sent.append(start)
+        if start > now:
+            time.sleep(start - now)
+
+    def observed_rate(self) -> Optional[float]:
+        """ Requests per second over the recent requests """
+        if len(self.sent) < 2 or self.sent[-1] <= self.sent[0]:
+            return None
+        return (len(self.sent) - 1) / (self.sent[-1] - self.sent[0])
+
+    def on_success(self, latency: float):
+        with self.lock:
+            if self.target_latency is not None and latency > self.target_latency:
+                self._decrease()
+            elif self.rate is not None:
+                # about +increase per second
+                self.rate += self.increase / self.rate
+                if self.max_rate is not None:
+                    self.rate = min(self.rate, self.max_rate)
+
+    def on_throttle(self, retry_after: Optional[float] = None):
+        with self.lock:
+            self._decrease()
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def _decrease(self):
+        now = time.monotonic()
+        # the in-flight requests of one overload report it together, slow down once for them
+        if now - self.decreased_at < 1:
+            return
+        self.decreased_at = now
+        rate = self.rate or self.observed_rate() or self.min_rate
+        self.rate = max(self.min_rate, rate * self.decrease)
+        self.next_time = max(self.next_time, now + 1 / self.rate)
+
+
+class RetryBudget:
+    """ Retries allowed as a share of the requests, so that retries cannot pile up on an overloaded API.
+
+    Every request earns `ratio` of a retry, up to `max_balance`, and the budget starts with `min_retries`.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_retries: int = 10, max_balance: Optional[float] = None):
+        self.lock = threading.Lock()
+        self.ratio = ratio
+        self.balance = float(min_retries)
+        self.max_balance = max_balance if max_balance is not None else max(float(min_retries), 100 * ratio)
+
+    def deposit(self):
+        with self.lock:
+            self.balance = min(self.max_balance, self.balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self.lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
@@ -1,23 +1,32 @@
 #!/usr/bin/env python3
 import datetime
-import hashlib
+import functools
 import io
 import sys
-from collections import defaultdict
+import time
+import tracemalloc
 from pathlib import Path
-from typing import Dict, Callable, Set, Optional
+from typing import Dict, Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
 
-import _jsonnet
 import pytz
-import sentry_sdk
 import simplejson as json
 import singer
 from jinja2 import Template
-from sentry_sdk import set_tag
 
-from target_miso.extensions import get_jinja_env
+from target_miso.extensions import get_jinja_env, load_field_mapping, FieldMapping
 from target_miso.py_extensions import import_code_path
-from .miso import MisoWriter, check_miso_data_type
+from .miso import MisoWriter, BatchLimit, DeadLetterFile, ID_FIELDS, check_miso_data_type
+from .rate_limit import RetryBudget
+from .id_set import IdSet, DEFAULT_MAX_IN_MEMORY
+from .journal import BatchJournal
+from .templates import LazyTemplates
+from .fan_out import CheckpointMerger, Tee, merge_states
+from .memory import MemoryMonitor
+from .metrics import metrics
+from .fingerprint import fingerprint, is_same_record
+from .upload_state import UploadState, DictUploadState, get_upload_state
+from .transform import RecordTransformer, eval_jsonnet, parse_messages, transform_messages, \
+    parallel_transform_messages  # noqa: F401
 
 logger = singer.get_logger()
 
@@ -31,14 +40,6 @@ def emit_state(state):
         sys.stdout.flush()
 
 
-def eval_jsonnet(snippet: str, data: dict):
-    data_json = json.dumps(data)
-    output = _jsonnet.evaluate_snippet(
-        "snippet",
-        f'local data = {data_json};\n' + snippet)
-    return json.loads(output)
-
-
 def timestamp_to_str(dt: datetime.datetime):
     """ convert a datetime to string """
     if dt.tzinfo is None:
@@ -47,129 +48,238 @@ def timestamp_to_str(dt: datetime.datetime):
     return dt.isoformat()
 
 
-# stream to the seen product_ids or user_ids
-stream_to_ids: Dict[str, Set] = defaultdict(set)
-# stream to data type
-stream_to_datatype: Dict[str, str] = {}
-
 MISO_STATE_KEY = '__miso_target_state__'
 
+FIELD_MAPPING_SUFFIX = '.fields.json'
+
+# fields of Miso records which may hold datetimes
+TIMESTAMP_FIELDS = ('updated_at', 'created_at', 'timestamp')
+
+
+class StreamPlan(NamedTuple):
+    """ What to do with the Miso records of a stream, worked out from its first record.
+
+    Each record is still checked against the data type, with as many lookups as classifying it.
+    The saving is the datetime scan, skipped for the templates which return JSON.
+    """
+    data_type: str
+    # product_id or user_id, None for interactions
+    id_field: Optional[str]
+    # only python templates can return datetime objects, the other templates return JSON
+    datetime_fields: Tuple[str, ...]
+
+
+def make_stream_plan(miso_record: Dict, template_kind: str) -> StreamPlan:
+    data_type = check_miso_data_type(miso_record)
+    return StreamPlan(data_type, ID_FIELDS.get(data_type),
+                      TIMESTAMP_FIELDS if template_kind == 'python' else ())
+
+
+def plan_matches(plan: StreamPlan, miso_record: Dict) -> bool:
+    """ Whether a record still has the data type of its stream plan, see check_miso_data_type """
+    if plan.data_type == 'products':
+        return 'product_id' in miso_record
+    if 'product_id' in miso_record:
+        return False
+    if plan.data_type == 'users':
+        return 'user_id' in miso_record and 'type' not in miso_record
+    return 'type' in miso_record and ('user_id' in miso_record or 'anonymous_id' in miso_record)
 
-def update_state(miso_upload_state: Dict, stream_name: str, record_id: str, record: Optional[Dict]):
+
+def update_state(upload_state: UploadState, stream_name: str, record_id: str, record: Optional[Dict],
+                 record_hash: Optional[str] = None):
     """ Remember what we uploaded """
-    if not miso_upload_state:
-        miso_upload_state = {}
-    if stream_name not in miso_upload_state:
-        miso_upload_state[stream_name] = {}
     if record:
-        record_hash = hashlib.md5(json.dumps(record, sort_keys=True).encode()).hexdigest()
-        miso_upload_state[stream_name][record_id] = record_hash
+        upload_state.set(stream_name, record_id, record_hash or fingerprint(record))
     else:
-        if record_id in miso_upload_state[stream_name]:
-            del miso_upload_state[stream_name][record_id]
-    return miso_upload_state
+        upload_state.delete(stream_name, record_id)
+    return upload_state
 
 
-def is_upload_needed(miso_upload_state: Dict, stream_name: str, record_id: str, record: Dict):
+def is_upload_needed(upload_state: UploadState, stream_name: str, record_id: str, record: Dict,
+                     record_hash: Optional[str] = None):
     """ Whether we need to upload a record to Miso """
-    if miso_upload_state is None:
-        return True
-    record_hash = hashlib.md5(json.dumps(record, sort_keys=True).encode()).hexdigest()
-    return miso_upload_state.get(stream_name, {}).get(record_id) != record_hash
+    record_hash = record_hash or fingerprint(record)
+    stored_hash = upload_state.get(stream_name, record_id)
+    if stored_hash == record_hash:
+        return False
+    if is_same_record(stored_hash, record, record_hash):
+        # unchanged since an earlier version stored its hash, switch to the current fingerprint
+        upload_state.set(stream_name, record_id, record_hash)
+        return False
+    return True
 
 
-def persist_messages(messages,
-                     miso_client: MisoWriter,
-                     stream_to_template_jsonnet: Dict[str, str],
-                     stream_to_template_jinja: Dict[str, Template],
-                     stream_to_python_func: Dict[str, Callable],
-                     extra_config):
+def transform_input(messages, transformer: RecordTransformer, extra_config: Dict) -> Iterator[Dict]:
+    """ Parse and transform the singer messages, in worker processes if configured """
+    batch_size = extra_config.get('transform_batch_size', 1)
+    workers = extra_config.get('transform_workers', 0)
+    fast_parse = extra_config.get('fast_parse', False)
+    if workers > 0:
+        return parallel_transform_messages(messages, transformer, workers, batch_size=batch_size,
+                                           chunk_size=extra_config.get('transform_chunk_size', 1000),
+                                           fast_parse=fast_parse)
+    return transform_messages(parse_messages(messages, fast_parse), transformer, batch_size=batch_size)
+
+
+def plan_messages(msg_objs: Iterable[Dict], transformer: RecordTransformer, extra_config: Dict) -> Iterator[Dict]:
+    """ Prepare the transformed messages for the writers.
+
+    Attach the `plan` of their stream to records and normalize their datetimes, mark the STATE
+    messages to `checkpoint` at, and emit the metrics every `metrics_interval`.
+    """
+    metrics_interval = extra_config.get('metrics_interval', 0)
+    metrics_prometheus_file = extra_config.get('metrics_prometheus_file')
+    metrics_emitted_at = time.monotonic()
+    # checkpoints: emit the latest STATE once the records before it are uploaded
+    state_interval = extra_config.get('state_interval', 0)
+    state_every_records = extra_config.get('state_every_records', 0)
+    state_emitted_at = time.monotonic()
+    records_since_state = 0
+    stream_to_plan: Dict[str, StreamPlan] = {}
+    for msg_obj in msg_objs:
+        if metrics_interval and time.monotonic() - metrics_emitted_at >= metrics_interval:
+            metrics.emit(metrics_prometheus_file)
+            metrics_emitted_at = time.monotonic()
+        message_type = msg_obj['type']
+        if message_type == 'RECORD':
+            stream_name = msg_obj['stream']
+            miso_record = msg_obj['miso_record']
+            records_since_state += 1
+            if miso_record:
+                plan = stream_to_plan.get(stream_name)
+                if plan is None or not plan_matches(plan, miso_record):
+                    # first record of the stream, or a template returning several data types
+                    plan = stream_to_plan[stream_name] = make_stream_plan(
+                        miso_record, transformer.template_kind(stream_name))
+                for field in plan.datetime_fields:
+                    if isinstance(miso_record.get(field), datetime.datetime):
+                        miso_record[field] = timestamp_to_str(miso_record[field])
+                msg_obj['plan'] = plan
+        elif message_type == 'STATE':
+            if (state_interval and time.monotonic() - state_emitted_at >= state_interval) or \
+                    (state_every_records and records_since_state >= state_every_records):
+                msg_obj['checkpoint'] = True
+                state_emitted_at = time.monotonic()
+                records_since_state = 0
+        elif message_type == 'SCHEMA':
+            # the template may return something else for the new schema
+            stream_to_plan.pop(msg_obj['stream'], None)
+        yield msg_obj
+
+
+def write_messages(msg_objs: Iterable[Dict],
+                   miso_client: MisoWriter,
+                   extra_config: Dict,
+                   upload_state: UploadState,
+                   state_key: str = MISO_STATE_KEY,
+                   emit: Callable[[Dict], None] = emit_state) -> Optional[Dict]:
+    """ Write the planned messages to a Miso destination, return the last state.
+
+    Messages may be shared with other destinations, they are not modified. None is returned when
+    batches failed without a journal to replay them: the upload state is not dumped, and the
+    last checkpoint emitted, if any, is the state to resume from.
+    """
     state = {}
-    miso_upload_state = {}
-    schemas = {}
-    for message in messages:
-        try:
-            msg_obj = singer.parse_message(message).asdict()
-        except json.decoder.JSONDecodeError:
-            raise ValueError(f"Unable to parse: {message}")
+    upload_state_loaded = False
+    fingerprint_algorithm = extra_config.get('fingerprint', 'blake2b')
+    max_ids_in_memory = extra_config.get('max_ids_in_memory', DEFAULT_MAX_IN_MEMORY)
+    # stream to the seen product_ids or user_ids
+    stream_to_ids: Dict[str, IdSet] = {}
+    # stream to data type
+    stream_to_datatype: Dict[str, str] = {}
+    memory = MemoryMonitor(extra_config.get('memory_report_interval', 0), extra_config.get('memory_limit_mb'),
+                           extra_config.get('memory_hard_limit_mb'))
+
+    def memory_sizes() -> Dict[str, int]:
+        sizes = {f'buffer:{data_type}': size for data_type, size in miso_client.memory_size().items()}
+        sizes.update({f'seen_ids:{stream_name}': ids.memory_size() for stream_name, ids in stream_to_ids.items()})
+        sizes['upload_state'] = upload_state.memory_size()
+        return sizes
+
+    def release_memory():
+        miso_client.flush()
+        for ids in stream_to_ids.values():
+            ids.spill()
+
+    for msg_obj in msg_objs:
+        if memory.enabled:
+            memory.tick(memory_sizes, release_memory)
         message_type = msg_obj['type']
-        if 'stream' in msg_obj and (msg_obj['stream'] not in stream_to_template_jsonnet and
-                                    msg_obj['stream'] not in stream_to_template_jinja and
-                                    msg_obj['stream'] not in stream_to_python_func
-        ):
-            raise ValueError(f"template for stream: {msg_obj['stream']} not found")
         if message_type == 'RECORD':
             # write a record to Miso
             stream_name = msg_obj['stream']
-            miso_record = None
-            if stream_name in stream_to_template_jsonnet:
-                template: str = stream_to_template_jsonnet[stream_name]
-                try:
-                    miso_record = eval_jsonnet(template, msg_obj['record'])
-                except Exception:
-                    logger.exception("Unable to parse record: %s", msg_obj['record'])
-            if stream_name in stream_to_template_jinja:
-                jinja_template: Template = stream_to_template_jinja[stream_name]
-                try:
-                    miso_record = json.loads(jinja_template.render(data=msg_obj['record']))
-                except Exception:
-                    logger.exception("Unable to parse record: %s", msg_obj['record'])
-            if stream_name in stream_to_python_func:
-                try:
-                    miso_record = stream_to_python_func[stream_name](msg_obj['record'])
-                except Exception:
-                    logger.exception("Unable to parse record: %s", msg_obj['record'])
+            miso_record = msg_obj['miso_record']
 
             if miso_record:
-                check_timestamp_fields = ['updated_at', 'created_at', 'timestamp']
-                for field in check_timestamp_fields:
-                    if isinstance(miso_record.get(field), datetime.datetime):
-                        miso_record[field] = timestamp_to_str(miso_record[field])
-                stream_to_datatype[stream_name] = check_miso_data_type(miso_record)
-                if stream_to_datatype[stream_name] != 'interactions':
-                    record_id = miso_record.get('product_id') or miso_record.get('user_id')
+                plan = msg_obj['plan']
+                stream_to_datatype[stream_name] = plan.data_type
+                if plan.id_field:
+                    record_id = miso_record[plan.id_field]
                     # maintain the ids we have seen
+                    if stream_name not in stream_to_ids:
+                        stream_to_ids[stream_name] = IdSet(max_ids_in_memory)
                     stream_to_ids[stream_name].add(record_id)
                     # whether we need to upload this record
-                    if is_upload_needed(miso_upload_state, stream_name, record_id, miso_record):
-                        miso_client.write_record(miso_record)
-                        #
-                        if stream_to_datatype[stream_name] == 'products':
-                            miso_upload_state = update_state(
-                                miso_upload_state, stream_name, record_id, record=miso_record
-                            )
+                    record_hash = fingerprint(miso_record, fingerprint_algorithm)
+                    if is_upload_needed(upload_state, stream_name, record_id, miso_record, record_hash):
+                        miso_client.write_record(miso_record, plan.data_type)
+                        update_state(upload_state, stream_name, record_id, miso_record, record_hash)
+                    else:
+                        metrics.incr('records_skipped_unchanged', stream=stream_name)
                 else:
                     # write interaction directly
-                    miso_client.write_record(miso_record)
-
+                    miso_client.write_record(miso_record, plan.data_type)
 
         elif message_type == 'STATE':
+            # don't let a quiet stream keep its records in the buffer
+            miso_client.flush_expired()
             logger.debug('Setting state to {}'.format(msg_obj['value']))
-            state = msg_obj['value']
-            if not miso_upload_state:
-                # update miso_upload_state
-                miso_upload_state = state.get(MISO_STATE_KEY, {})
+            state = dict(msg_obj['value'])
+            if not upload_state_loaded and state_key in state:
+                # restore what previous runs uploaded
+                upload_state.load(state[state_key])
+                upload_state_loaded = True
+            if msg_obj.get('checkpoint'):
+                # wait for every batch sent so far, failed ones are left in the journal
+                miso_client.flush()
+                if miso_client.journal is None and miso_client.failed_batches:
+                    # the records of the failed batches would be lost behind this STATE
+                    logger.warning('Hold the STATE checkpoint: %s batches failed and there is no journal_folder',
+                                   miso_client.failed_batches)
+                    metrics.incr('states_held')
+                    emit(None)
+                else:
+                    # the emit function may keep the state while more records are written, e.g. until
+                    # the other destinations reach this checkpoint
+                    state[state_key] = upload_state.snapshot()
+                    emit(state)
+                    metrics.incr('states_emitted')
         elif message_type == 'SCHEMA':
-            stream = msg_obj['stream']
-            schemas[stream] = msg_obj['schema']
+            # plans are reset by plan_messages
+            pass
         elif message_type == 'ACTIVATE_VERSION':
             logger.warning('ACTIVATE_VERSION %s', msg_obj)
             stream_name = msg_obj['stream']
             data_type = stream_to_datatype.get(stream_name)
-            shall_delete = not extra_config['insert_only']
+            shall_delete = not extra_config.get('insert_only', False)
             if shall_delete and stream_to_ids.get(stream_name) and data_type in ('users', 'products'):
                 logger.warning('Perform ids check %s:%s', stream_name, msg_obj['version'])
-                existing_ids: Set[str] = set(miso_client.get_existing_ids(data_type))
-                to_delete_ids = existing_ids - stream_to_ids[stream_name]
+                existing_ids = IdSet(max_ids_in_memory)
+                existing_ids.update(miso_client.get_existing_ids(data_type))
+                to_delete_ids = list(existing_ids.difference(stream_to_ids[stream_name]))
+                existing_ids.close()
                 if to_delete_ids:
-                    logger.warning('Delete %s %s: %s', len(to_delete_ids), stream_name, to_delete_ids)
-                    miso_client.delete_records(to_delete_ids, data_type)
-                    for record_id in to_delete_ids:
+                    logger.warning('Delete %s %s', len(to_delete_ids), stream_name)
+                    deleted_ids = miso_client.delete_records(to_delete_ids, data_type)
+                    if len(deleted_ids) < len(to_delete_ids):
+                        logger.warning('Failed to delete %s %s', len(to_delete_ids) - len(deleted_ids), stream_name)
+                    for record_id in deleted_ids:
                         # maintain state
-                        miso_upload_state = update_state(miso_upload_state, stream_name, record_id, None)
+                        update_state(upload_state, stream_name, record_id, None)
                 else:
                     logger.warning('No need to delete anything from Miso for %s', stream_name)
-                del stream_to_ids[stream_name]
+                stream_to_ids.pop(stream_name).close()
                 del stream_to_datatype[stream_name]
             else:
                 logger.warning("Ignore ACTIVATE_VERSION %s", msg_obj)
@@ -177,55 +287,250 @@ def persist_messages(messages,
             logger.warning("Unknown message type {} in message {}".format(msg_obj['type'], msg_obj))
     # write remain records in the buffer
     miso_client.flush()
-    state[MISO_STATE_KEY] = miso_upload_state
+    for ids in stream_to_ids.values():
+        ids.close()
+    if miso_client.journal is None and miso_client.failed_batches:
+        # the tap state and the hashes would move past the failed records, the last checkpoint stands
+        logger.error('%s batches failed and there is no journal_folder, the final STATE is not emitted',
+                     miso_client.failed_batches)
+        return None
+    state[state_key] = upload_state.dump()
     return state
 
+
+def persist_messages(messages,
+                     miso_client: MisoWriter,
+                     stream_to_template_jsonnet: Dict[str, str],
+                     stream_to_template_jinja: Dict[str, Template],
+                     stream_to_python_func: Dict[str, Callable],
+                     extra_config: Optional[Dict] = None,
+                     upload_state: Optional[UploadState] = None):
+    extra_config = extra_config or {}
+    transformer = RecordTransformer(stream_to_template_jsonnet, stream_to_template_jinja, stream_to_python_func)
+    msg_objs = plan_messages(transform_input(messages, transformer, extra_config), transformer, extra_config)
+    state = write_messages(msg_objs, miso_client, extra_config, upload_state or DictUploadState())
+    metrics.emit(extra_config.get('metrics_prometheus_file'))
+    return state
+
+
+class Destination(NamedTuple):
+    """ One of the Miso environments records are written to """
+    name: str
+    miso_client: MisoWriter
+    # called in the thread of the destination, SQLite connections can't be shared between threads
+    open_upload_state: Callable[[], UploadState]
+    extra_config: Dict
+
+
+def destination_state_key(name: str) -> str:
+    return f'{MISO_STATE_KEY}:{name}'
+
+
+def fan_out_messages(messages,
+                     destinations: List[Destination],
+                     stream_to_template_jsonnet: Dict[str, str],
+                     stream_to_template_jinja: Dict[str, Template],
+                     stream_to_python_func: Dict[str, Callable],
+                     extra_config: Optional[Dict] = None,
+                     max_pending: int = 10000) -> Optional[Dict]:
+    """ Transform the messages once and write them to several destinations, each in its own thread.
+
+    A destination falls at most `max_pending` messages behind the others. Checkpoints are emitted
+    once every destination has reached them, the upload state of each one under its own key.
+    """
+    extra_config = extra_config or {}
+    transformer = RecordTransformer(stream_to_template_jsonnet, stream_to_template_jinja, stream_to_python_func)
+    msg_objs = plan_messages(transform_input(messages, transformer, extra_config), transformer, extra_config)
+    merger = CheckpointMerger([d.name for d in destinations], emit_state)
+
+    def consume(index: int, destination_msg_objs: Iterator[Dict]) -> Dict:
+        destination = destinations[index]
+        upload_state = destination.open_upload_state()
+        try:
+            return write_messages(destination_msg_objs, destination.miso_client, destination.extra_config,
+                                  upload_state, destination_state_key(destination.name),
+                                  merger.emitter(destination.name))
+        finally:
+            upload_state.close()
+
+    states = Tee(len(destinations), max_pending).run(msg_objs, consume)
+    metrics.emit(extra_config.get('metrics_prometheus_file'))
+    if None in states:
+        # a destination lost records, the last checkpoint all of them reached stands
+        return None
+    return merge_states(states)
+
+
 def is_truthy(value):
     return (str(value).lower() in ('true', '1')) if value != None else False
 
-def main():
-    params = singer.utils.parse_args({'template_folder', 'api_key'})
-
-    # load Miso API parameters
-    api_server = params.config.get('api_server') or 'https://api.askmiso.com'
-    api_key = params.config['api_key']
-    use_async = is_truthy(params.config.get('use_async'))
-    dry_run = is_truthy(params.config.get('dry_run'))
-    write_record_limit = int(params.config.get('write_record_limit', 100))
-
-    miso_client = MisoWriter(api_server, api_key, use_async, dry_run, write_record_limit)
-    extra_config = {
-        'insert_only': is_truthy(params.config.get('insert_only'))
+
+def parse_batch_limits(config: Dict, write_record_limit: int) -> Dict[str, BatchLimit]:
+    """ Batch limits of each data type from the target config """
+    default_max_records = {'products': write_record_limit, 'users': write_record_limit, 'interactions': 1000}
+    max_bytes = config.get('max_batch_bytes')
+    max_age = config.get('max_batch_age')
+    type_to_limit = {}
+    for data_type, max_records in default_max_records.items():
+        override = (config.get('batch_limits') or {}).get(data_type, {})
+        type_max_bytes = override.get('max_bytes', max_bytes)
+        type_max_age = override.get('max_age', max_age)
+        type_to_limit[data_type] = BatchLimit(
+            max_records=int(override.get('max_records', max_records)),
+            max_bytes=int(type_max_bytes) if type_max_bytes else None,
+            max_age=float(type_max_age) if type_max_age else None,
+        )
+    return type_to_limit
+
+
+def build_miso_writer(config: Dict) -> MisoWriter:
+    """ The writer of a Miso destination from the target config """
+    api_server = config.get('api_server') or 'https://api.askmiso.com'
+    api_key = config['api_key']
+    use_async = is_truthy(config.get('use_async'))
+    dry_run = is_truthy(config.get('dry_run'))
+    write_record_limit = int(config.get('write_record_limit', 100))
+    max_in_flight = int(config.get('max_in_flight', 1))
+    payload_encoding = config.get('payload_encoding') or 'json'
+    batch_limits = parse_batch_limits(config, write_record_limit)
+
+    delete_chunk_size = int(config.get('delete_chunk_size', 1000))
+    journal = None
+    if config.get('journal_folder'):
+        journal = BatchJournal(config['journal_folder'], fsync=is_truthy(config.get('journal_fsync', True)))
+
+    rate_limit = {}
+    if config.get('max_requests_per_second'):
+        rate_limit['max_rate'] = float(config['max_requests_per_second'])
+    if config.get('target_latency'):
+        rate_limit['target_latency'] = float(config['target_latency'])
+    retry_budget = RetryBudget(ratio=float(config.get('retry_budget', 0.2)))
+
+    return MisoWriter(api_server, api_key, use_async, dry_run, write_record_limit, max_in_flight,
+                      payload_encoding, batch_limits, delete_chunk_size, journal=journal,
+                      max_retries=int(config.get('max_retries', 3)),
+                      retry_budget=retry_budget, rate_limit=rate_limit,
+                      dead_letter=DeadLetterFile(config['dead_letter_file']) if config.get('dead_letter_file') else None,
+                      coalesce_records=is_truthy(config.get('coalesce_records', True)))
+
+
+def build_extra_config(config: Dict) -> Dict:
+    return {
+        'insert_only': is_truthy(config.get('insert_only')),
+        'transform_batch_size': int(config.get('transform_batch_size', 100)),
+        'fast_parse': is_truthy(config.get('fast_parse')),
+        'transform_workers': int(config.get('transform_workers', 0)),
+        'transform_chunk_size': int(config.get('transform_chunk_size', 1000)),
+        'fingerprint': config.get('fingerprint') or 'blake2b',
+        'metrics_interval': float(config.get('metrics_interval', 0)),
+        'metrics_prometheus_file': config.get('metrics_prometheus_file'),
+        'max_ids_in_memory': int(config.get('max_ids_in_memory', DEFAULT_MAX_IN_MEMORY)),
+        'state_interval': float(config.get('state_interval', 0)),
+        'state_every_records': int(config.get('state_every_records', 0)),
+        'memory_report_interval': float(config.get('memory_report_interval', 0)),
+        'memory_limit_mb': float(config['memory_limit_mb']) if config.get('memory_limit_mb') else None,
+        'memory_hard_limit_mb': float(config['memory_hard_limit_mb']) if config.get('memory_hard_limit_mb') else None,
     }
 
+
+def build_upload_state(config: Dict) -> UploadState:
+    return get_upload_state(config.get('upload_state_backend') or 'state',
+                            config.get('upload_state_path'),
+                            is_truthy(config.get('compact_upload_state')))
+
+
+# options naming a file or folder, which destinations can't share
+DESTINATION_PATH_OPTIONS = ('journal_folder', 'upload_state_path', 'dead_letter_file')
+
+
+def destination_config(config: Dict, destination: Dict) -> Dict:
+    """ The config of a destination: its own options over the top-level ones """
+    name = destination['name']
+    merged = {key: value for key, value in config.items() if key != 'destinations'}
+    for key in DESTINATION_PATH_OPTIONS:
+        if merged.get(key) and key not in destination:
+            merged[key] = f'{merged[key]}.{name}'
+    merged.update(destination)
+    if not merged.get('api_key'):
+        raise ValueError(f'api_key is required by destination {name}')
+    return merged
+
+
+def main():
+    params = singer.utils.parse_args({'template_folder'})
+    destinations_config = params.config.get('destinations') or []
+    if not destinations_config and 'api_key' not in params.config:
+        raise Exception('Config is missing required keys: api_key')
+    if len({d.get('name') for d in destinations_config}) != len(destinations_config) or \
+            not all(d.get('name') for d in destinations_config):
+        raise ValueError('Each destination needs a unique name')
+
+    extra_config = build_extra_config(params.config)
+    if is_truthy(params.config.get('memory_tracemalloc')):
+        # slows the run down, for finding out where the memory goes
+        tracemalloc.start()
+
     if 'sentry_dsn' in params.config:
+        import sentry_sdk
         sentry_sdk.init(dsn=params.config['sentry_dsn'])
         if 'sentry_source' in params.config:
-            set_tag("source", params.config['sentry_source'])
+            sentry_sdk.set_tag("source", params.config['sentry_source'])
 
-    # load templates
+    # find templates, each one is loaded when its stream shows up
     template_folder_path = Path(params.config['template_folder'])
     if not template_folder_path.exists():
         raise ValueError(f"template_folder {params.config['template_folder']} does not exist")
-    stream_to_template_jsonnet = {
-        path.stem: path.open().read() for path in
-        template_folder_path.glob('*.jsonnet')}
-    jinja_env = get_jinja_env(template_folder_path)
-    stream_to_template_jinja: Dict[str, Template] = {
-        path.stem: jinja_env.get_template(path.name) for path in
-        template_folder_path.glob('*.jinja')}
-    stream_to_python_func: Dict[str, Callable] = {
-        path.stem: import_code_path(path)
-        for path in
-        template_folder_path.glob('*.py')}
+    template_cache_folder = params.config.get('template_cache_folder')
+    stream_to_template_jsonnet: Dict[str, str] = LazyTemplates(
+        {path.stem: path for path in template_folder_path.glob('*.jsonnet')},
+        lambda path: path.read_text())
+    jinja_env = get_jinja_env(template_folder_path,
+                              Path(template_cache_folder, 'jinja') if template_cache_folder else None)
+    jinja_paths = {path.stem: path for path in template_folder_path.glob('*.jinja')}
+    jinja_paths.update({path.name[:-len(FIELD_MAPPING_SUFFIX)]: path
+                        for path in template_folder_path.glob('*' + FIELD_MAPPING_SUFFIX)})
+    stream_to_template_jinja: Dict[str, Union[Template, FieldMapping]] = LazyTemplates(
+        jinja_paths,
+        lambda path: load_field_mapping(path, jinja_env) if path.name.endswith(FIELD_MAPPING_SUFFIX)
+        else jinja_env.get_template(path.name))
+    stream_to_python_func: Dict[str, Callable] = LazyTemplates(
+        {path.stem: path for path in template_folder_path.glob('*.py')},
+        lambda path: import_code_path(path, Path(template_cache_folder, 'python') if template_cache_folder else None))
 
     input_messages = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
-    state = persist_messages(input_messages,
-                             miso_client,
-                             stream_to_template_jsonnet,
-                             stream_to_template_jinja,
-                             stream_to_python_func,
-                             extra_config)
+    if destinations_config:
+        destinations = []
+        for destination in destinations_config:
+            config = destination_config(params.config, destination)
+            destinations.append(Destination(destination['name'], build_miso_writer(config),
+                                            functools.partial(build_upload_state, config),
+                                            build_extra_config(config)))
+        for destination in destinations:
+            # batches of a previous run which were not acknowledged go first
+            destination.miso_client.replay_journal()
+        state = fan_out_messages(input_messages,
+                                 destinations,
+                                 stream_to_template_jsonnet,
+                                 stream_to_template_jinja,
+                                 stream_to_python_func,
+                                 extra_config,
+                                 int(params.config.get('destination_max_pending', 10000)))
+        for destination in destinations:
+            destination.miso_client.close()
+    else:
+        miso_client = build_miso_writer(params.config)
+        upload_state = build_upload_state(params.config)
+        # batches of a previous run which were not acknowledged go first
+        miso_client.replay_journal()
+        state = persist_messages(input_messages,
+                                 miso_client,
+                                 stream_to_template_jsonnet,
+                                 stream_to_template_jinja,
+                                 stream_to_python_func,
+                                 extra_config,
+                                 upload_state)
+        miso_client.close()
+        upload_state.close()
 
     emit_state(state)
     logger.debug("Exiting normally")
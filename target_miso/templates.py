@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, Mapping
+
+import singer
+
+logger = singer.get_logger()
+
+
+class LazyTemplates(Mapping):
+    """ Templates of a folder by stream, each loaded the first time its stream needs it """
+
+    def __init__(self, stream_to_path: Dict[str, Path], load: Callable[[Path], Any]):
+        self.stream_to_path = stream_to_path
+        self.load = load
+        self.loaded: Dict[str, Any] = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, stream_name: str) -> Any:
+        try:
+            return self.loaded[stream_name]
+        except KeyError:
+            pass
+        path = self.stream_to_path[stream_name]
+        with self.lock:
+            if stream_name not in self.loaded:
+                logger.info('Load template %s', path)
+                self.loaded[stream_name] = self.load(path)
+        return self.loaded[stream_name]
+
+    def __contains__(self, stream_name) -> bool:
+        return stream_name in self.stream_to_path
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.stream_to_path)
+
+    def __len__(self) -> int:
+        return len(self.stream_to_path)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+import multiprocessing
+import threading
+from collections import deque
+from functools import lru_cache
+from itertools import islice
+from typing import Dict, Callable, Iterable, Iterator, List, Optional, Tuple, Union
+
+import simplejson as json
+import singer
+from jinja2 import Template
+
+from .extensions import FieldMapping
+from .metrics import metrics
+from .py_extensions import get_transform_batch
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = singer.get_logger()
+
+
+class JsonnetTemplate:
+    """ A jsonnet template compiled once into top-level functions of the record """
+
+    def __init__(self, snippet: str, name: str = 'snippet'):
+        self.name = name
+        self.snippet = snippet
+        # the template body becomes a function of `data`, fed through tla_codes
+        self.record_code = f'function(data) (\n{snippet}\n)\n'
+        self.batch_code = f'function(records) std.map(function(data) (\n{snippet}\n), records)\n'
+
+    def evaluate(self, data: Dict):
+        """ Transform a single record """
+        import _jsonnet
+        output = _jsonnet.evaluate_snippet(self.name, self.record_code, tla_codes={'data': json.dumps(data)})
+        return json.loads(output)
+
+    def evaluate_batch(self, records: List[Dict]) -> List:
+        """ Transform a list of records in one jsonnet evaluation """
+        import _jsonnet
+        output = _jsonnet.evaluate_snippet(self.name, self.batch_code, tla_codes={'records': json.dumps(records)})
+        return json.loads(output)
+
+
+@lru_cache(maxsize=64)
+def compile_jsonnet(snippet: str, name: str = 'snippet') -> JsonnetTemplate:
+    """ Get the compiled template of a jsonnet snippet """
+    return JsonnetTemplate(snippet, name)
+
+
+def eval_jsonnet(snippet: str, data: dict):
+    return compile_jsonnet(snippet).evaluate(data)
+
+
+class RecordTransformer:
+    """ Transform tap records to Miso records with the template of their stream """
+
+    def __init__(self,
+                 stream_to_template_jsonnet: Dict[str, str],
+                 stream_to_template_jinja: Dict[str, Union[Template, FieldMapping]],
+                 stream_to_python_func: Dict[str, Callable]):
+        self.stream_to_template_jsonnet = stream_to_template_jsonnet
+        self.stream_to_template_jinja = stream_to_template_jinja
+        self.stream_to_python_func = stream_to_python_func
+
+    def has_template(self, stream_name: str) -> bool:
+        return (stream_name in self.stream_to_template_jsonnet or
+                stream_name in self.stream_to_template_jinja or
+                stream_name in self.stream_to_python_func)
+
+    def supports_batch(self, stream_name: str) -> bool:
+        """ Whether records of the stream can be transformed in batches """
+        if stream_name in self.stream_to_python_func:
+            return get_transform_batch(self.stream_to_python_func[stream_name]) is not None
+        return (stream_name in self.stream_to_template_jsonnet and
+                stream_name not in self.stream_to_template_jinja)
+
+    def _jsonnet(self, stream_name: str) -> JsonnetTemplate:
+        template = self.stream_to_template_jsonnet[stream_name]
+        if isinstance(template, JsonnetTemplate):
+            return template
+        return compile_jsonnet(template, stream_name)
+
+    def template_kind(self, stream_name: str) -> str:
+        if stream_name in self.stream_to_python_func:
+            return 'python'
+        if stream_name in self.stream_to_template_jinja:
+            return 'jinja'
+        return 'jsonnet'
+
+    def transform(self, stream_name: str, record: Dict) -> Optional[Dict]:
+        """ Transform a record, return None if the template fails """
+        kind = self.template_kind(stream_name)
+        with metrics.timer('transform', kind=kind):
+            miso_record = self._transform(stream_name, record)
+        metrics.incr('records_transformed' if miso_record else 'records_not_transformed', stream=stream_name)
+        return miso_record
+
+    def _transform(self, stream_name: str, record: Dict) -> Optional[Dict]:
+        miso_record = None
+        if stream_name in self.stream_to_template_jsonnet:
+            # templates which fail to load raise, rather than failing every record
+            jsonnet_template = self._jsonnet(stream_name)
+            try:
+                miso_record = jsonnet_template.evaluate(record)
+            except Exception:
+                logger.exception("Unable to parse record: %s", record)
+        if stream_name in self.stream_to_template_jinja:
+            jinja_template = self.stream_to_template_jinja[stream_name]
+            try:
+                if isinstance(jinja_template, FieldMapping):
+                    miso_record = jinja_template.render_object(record)
+                else:
+                    miso_record = json.loads(jinja_template.render(data=record))
+            except Exception:
+                logger.exception("Unable to parse record: %s", record)
+        if stream_name in self.stream_to_python_func:
+            python_func = self.stream_to_python_func[stream_name]
+            try:
+                miso_record = python_func(record)
+            except Exception:
+                logger.exception("Unable to parse record: %s", record)
+        return miso_record
+
+    def transform_batch(self, stream_name: str, records: List[Dict]) -> List[Optional[Dict]]:
+        """ Transform a list of records of the same stream """
+        if len(records) > 1 and self.supports_batch(stream_name):
+            try:
+                with metrics.timer('transform_batch', kind=self.template_kind(stream_name)):
+                    miso_records = self._transform_batch(stream_name, records)
+                metrics.incr('records_transformed', sum(1 for r in miso_records if r), stream=stream_name)
+                metrics.incr('records_not_transformed', sum(1 for r in miso_records if not r), stream=stream_name)
+                return miso_records
+            except Exception:
+                # find out the bad records one by one
+                logger.exception("Batch transform of %s records failed, retry one by one", len(records))
+        return [self.transform(stream_name, record) for record in records]
+
+    def _transform_batch(self, stream_name: str, records: List[Dict]) -> List[Optional[Dict]]:
+        if stream_name in self.stream_to_python_func:
+            miso_records = list(get_transform_batch(self.stream_to_python_func[stream_name])(records))
+            if len(miso_records) != len(records):
+                raise ValueError(f'transform_batch returned {len(miso_records)} records '
+                                 f'for {len(records)} records')
+            return miso_records
+        return self._jsonnet(stream_name).evaluate_batch(records)
+
+
+def fast_parse_message(message: str) -> Dict:
+    """ Parse a singer message, RECORD messages skip singer's message objects.
+
+    Numbers are decoded as floats instead of decimals, and `time_extracted` is kept as it is.
+    """
+    obj = orjson.loads(message) if orjson is not None else json.loads(message)
+    if obj.get('type') == 'RECORD' and 'stream' in obj and 'record' in obj:
+        return obj
+    return singer.parse_message(message).asdict()
+
+
+def parse_messages(messages: Iterable[str], fast: bool = False) -> Iterator[Dict]:
+    """ Parse singer messages """
+    for message in messages:
+        try:
+            if fast:
+                msg_obj = fast_parse_message(message)
+            else:
+                msg_obj = singer.parse_message(message).asdict()
+        except ValueError:
+            raise ValueError(f"Unable to parse: {message}")
+        if msg_obj['type'] == 'RECORD':
+            metrics.incr('records_parsed', stream=msg_obj['stream'])
+        yield msg_obj
+
+
+def transform_messages(msg_objs: Iterable[Dict],
+                       transformer: RecordTransformer,
+                       batch_size: int = 1) -> Iterator[Dict]:
+    """ Attach the transformed `miso_record` to RECORD messages, keeping the message order.
+
+    Consecutive records of a stream are transformed together, up to `batch_size` records.
+    Any other message ends the batch, so it is yielded after the records before it.
+    """
+    pending: List[Dict] = []
+
+    def drain():
+        if not pending:
+            return
+        miso_records = transformer.transform_batch(pending[0]['stream'], [m['record'] for m in pending])
+        for msg_obj, miso_record in zip(pending, miso_records):
+            msg_obj['miso_record'] = miso_record
+            yield msg_obj
+        pending.clear()
+
+    for msg_obj in msg_objs:
+        if 'stream' in msg_obj and not transformer.has_template(msg_obj['stream']):
+            raise ValueError(f"template for stream: {msg_obj['stream']} not found")
+        if msg_obj['type'] != 'RECORD':
+            yield from drain()
+            yield msg_obj
+            continue
+        stream_name = msg_obj['stream']
+        if pending and pending[0]['stream'] != stream_name:
+            yield from drain()
+        pending.append(msg_obj)
+        if len(pending) >= batch_size or not transformer.supports_batch(stream_name):
+            yield from drain()
+    yield from drain()
+
+
+# the transformer of a worker process, inherited from the parent process by fork
+_worker_transformer: Optional[RecordTransformer] = None
+
+
+def _init_worker(transformer: RecordTransformer):
+    global _worker_transformer
+    _worker_transformer = transformer
+    # forget the metrics copied from the main process, the lock may have been held by one of its threads
+    metrics.lock = threading.Lock()
+    metrics.reset()
+
+
+def _transform_chunk(lines: List[str], batch_size: int, fast_parse: bool) -> Tuple[List[Dict], Dict]:
+    msg_objs = list(transform_messages(parse_messages(lines, fast_parse), _worker_transformer, batch_size))
+    # the metrics of the worker go back to the main process
+    return msg_objs, metrics.drain()
+
+
+def parallel_transform_messages(messages: Iterable[str],
+                                transformer: RecordTransformer,
+                                workers: int,
+                                batch_size: int = 1,
+                                chunk_size: int = 1000,
+                                fast_parse: bool = False) -> Iterator[Dict]:
+    """ Parse and transform raw singer messages in a pool of worker processes.
+
+    Lines are sent to the workers in chunks and the results are yielded in the input order,
+    so STATE and ACTIVATE_VERSION messages stay behind the records before them.
+    At most two chunks per worker are pending at a time.
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        # templates and python functions can't be pickled to spawned workers
+        logger.warning("Multi-process transform needs fork, transform in the main process")
+        yield from transform_messages(parse_messages(messages, fast_parse), transformer, batch_size)
+        return
+    messages = iter(messages)
+    context = multiprocessing.get_context('fork')
+    with context.Pool(workers, initializer=_init_worker, initargs=(transformer,)) as pool:
+        pending = deque()
+        while True:
+            while len(pending) < workers * 2:
+                lines = list(islice(messages, chunk_size))
+                if not lines:
+                    break
+                pending.append(pool.apply_async(_transform_chunk, (lines, batch_size, fast_parse)))
+            if not pending:
+                break
+            msg_objs, worker_metrics = pending.popleft().get()
+            metrics.merge(worker_metrics)
+            yield from msg_objs
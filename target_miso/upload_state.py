@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+import base64
+import sqlite3
+import zlib
+from pathlib import Path
+from typing import Dict, Optional, Set, Union
+
+import simplejson as json
+import singer
+
+from .memory import estimate_size
+
+logger = singer.get_logger()
+
+
+class UploadState:
+    """ Remember the hash of each record uploaded to Miso, per stream """
+
+    def get(self, stream_name: str, record_id: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, stream_name: str, record_id: str, record_hash: str):
+        raise NotImplementedError
+
+    def delete(self, stream_name: str, record_id: str):
+        raise NotImplementedError
+
+    def load(self, value):
+        """ Restore from the value kept in the Singer state """
+        raise NotImplementedError
+
+    def dump(self):
+        """ Persist the changes, return the value to keep in the Singer state """
+        raise NotImplementedError
+
+    def snapshot(self):
+        """ Like `dump`, with a value which doesn't change as records are written afterwards """
+        return self.dump()
+
+    def close(self):
+        pass
+
+    def memory_size(self) -> int:
+        """ The approximate size of the hashes held in memory """
+        return 0
+
+
+COMPACT_ENCODING = 'zlib+base64'
+
+
+def encode_hashes(hashes: Dict[str, str]) -> str:
+    return base64.b64encode(zlib.compress(json.dumps(hashes, separators=(',', ':')).encode())).decode()
+
+
+def decode_hashes(value: str) -> Dict[str, str]:
+    return json.loads(zlib.decompress(base64.b64decode(value)))
+
+
+def decode_stream_hashes(value: Dict) -> Dict[str, Dict[str, str]]:
+    """ The hashes of each stream from a value dumped by DictUploadState, compact or not """
+    if value.get('encoding') == COMPACT_ENCODING:
+        return {stream_name: decode_hashes(encoded) for stream_name, encoded in value['streams'].items()}
+    return value
+
+
+class DictUploadState(UploadState):
+    """ All the hashes in a dict, embedded in the Singer state.
+
+    With `compact`, each stream is dumped as compressed JSON, and only the streams changed since
+    the last dump are encoded again, which keeps frequent checkpoints cheap.
+    """
+
+    def __init__(self, stream_to_hashes: Optional[Dict[str, Dict[str, str]]] = None, compact: bool = False):
+        self.stream_to_hashes: Dict[str, Dict[str, str]] = stream_to_hashes or {}
+        self.compact = compact
+        self.stream_to_encoded: Dict[str, str] = {}
+        self.changed_streams: Set[str] = set(self.stream_to_hashes)
+
+    def get(self, stream_name: str, record_id: str) -> Optional[str]:
+        return self.stream_to_hashes.get(stream_name, {}).get(record_id)
+
+    def set(self, stream_name: str, record_id: str, record_hash: str):
+        self.stream_to_hashes.setdefault(stream_name, {})[record_id] = record_hash
+        self.changed_streams.add(stream_name)
+
+    def delete(self, stream_name: str, record_id: str):
+        self.stream_to_hashes.get(stream_name, {}).pop(record_id, None)
+        self.changed_streams.add(stream_name)
+
+    def load(self, value):
+        if not value or 'backend' in value:
+            return
+        value = decode_stream_hashes(value)
+        self.changed_streams.update(value)
+        for stream_name, hashes in value.items():
+            # hashes of this run are newer than the ones from the state
+            current = self.stream_to_hashes.setdefault(stream_name, {})
+            for record_id, record_hash in hashes.items():
+                current.setdefault(record_id, record_hash)
+
+    def memory_size(self) -> int:
+        size = sum(len(encoded) for encoded in self.stream_to_encoded.values())
+        for hashes in self.stream_to_hashes.values():
+            size += estimate_size(hashes, hashes.items(), len(hashes))
+        return size
+
+    def dump(self):
+        if not self.compact:
+            return self.stream_to_hashes
+        for stream_name in self.changed_streams:
+            self.stream_to_encoded[stream_name] = encode_hashes(self.stream_to_hashes.get(stream_name, {}))
+        self.changed_streams.clear()
+        return {'encoding': COMPACT_ENCODING, 'streams': dict(self.stream_to_encoded)}
+
+    def snapshot(self):
+        value = self.dump()
+        if self.compact:
+            return value
+        return {stream_name: dict(hashes) for stream_name, hashes in value.items()}
+
+
+class SqliteUploadState(UploadState):
+    """ Hashes in a local SQLite file, the Singer state only keeps a pointer to it.
+
+    Changes are committed by `dump`, after the records have been sent, so a crashed run
+    leaves the file as it was at the last emitted state.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = str(path)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS upload_state ('
+                          'stream TEXT NOT NULL, record_id TEXT NOT NULL, hash TEXT NOT NULL, '
+                          'PRIMARY KEY (stream, record_id)) WITHOUT ROWID')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+        self.conn.commit()
+
+    @property
+    def version(self) -> int:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def get(self, stream_name: str, record_id: str) -> Optional[str]:
+        row = self.conn.execute('SELECT hash FROM upload_state WHERE stream = ? AND record_id = ?',
+                                (stream_name, str(record_id))).fetchone()
+        return row[0] if row else None
+
+    def set(self, stream_name: str, record_id: str, record_hash: str):
+        self.conn.execute('INSERT OR REPLACE INTO upload_state VALUES (?, ?, ?)',
+                          (stream_name, str(record_id), record_hash))
+
+    def delete(self, stream_name: str, record_id: str):
+        self.conn.execute('DELETE FROM upload_state WHERE stream = ? AND record_id = ?',
+                          (stream_name, str(record_id)))
+
+    def load(self, value):
+        if not value:
+            return
+        if 'backend' in value:
+            if value.get('version') != self.version:
+                logger.warning('Upload state %s is at version %s, the Singer state expects version %s',
+                               self.path, self.version, value.get('version'))
+            return
+        # migrate the hashes embedded in an older Singer state
+        value = decode_stream_hashes(value)
+        logger.info('Import upload state of %s streams into %s', len(value), self.path)
+        for stream_name, hashes in value.items():
+            self.conn.executemany('INSERT OR IGNORE INTO upload_state VALUES (?, ?, ?)',
+                                  ((stream_name, str(record_id), record_hash)
+                                   for record_id, record_hash in hashes.items()))
+
+    def dump(self):
+        version = self.version + 1
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+        self.conn.commit()
+        return {'backend': 'sqlite', 'path': self.path, 'version': version}
+
+    def close(self):
+        self.conn.close()
+
+
+def get_upload_state(backend: str = 'state', path: Optional[str] = None, compact: bool = False) -> UploadState:
+    """ Create the upload state backend from the target config """
+    if backend == 'state':
+        return DictUploadState(compact=compact)
+    if backend == 'sqlite':
+        if not path:
+            raise ValueError('upload_state_path is required by the sqlite upload state')
+        return SqliteUploadState(path)
+    raise ValueError(f'Unknown upload_state_backend: {backend}')
@@ -0,0 +1,81 @@
+""" Test built-in jinja filters """
+import dateparser
+import pytest
+
+from target_miso.extensions import FieldMapping, datetime_format, get_jinja_env, memoize, parse_iso_datetime, \
+    remove_symbol
+
+
+@pytest.mark.parametrize('value', [
+    '2022-03-26T18:45:53+00:00', '2022-03-26T18:45:53Z', '2022-03-26T18:45:53.123456+08:00',
+    '2022-03-26 18:45:53', '2022-03-26 18:45', '2022-03-26', '2022/03/26 18:45:53',
+    '2022-03-26T18:45:53-05:00', '2022-03-26T18:45:53+0800',
+])
+def test_datetime_format_fast_path(value):
+    """ Test the ISO fast path gives the same result as dateparser """
+    assert parse_iso_datetime(value) is not None
+    expected = dateparser.parse(value)
+    if expected.tzinfo is None:
+        expected = expected.replace(tzinfo=parse_iso_datetime('2000-01-01Z').tzinfo)
+    assert datetime_format(value) == expected.replace(microsecond=0).isoformat()
+
+
+def test_datetime_format_fallback():
+    """ Test other formats still go through dateparser """
+    assert parse_iso_datetime('March 26, 2022 6:45 PM') is None
+    assert datetime_format('March 26, 2022 6:45 PM') == '2022-03-26T18:45:00+00:00'
+
+
+def test_memoize():
+    """ Test a filter raising TypeError runs once, and unhashable values are not cached """
+    calls = []
+
+    @memoize
+    def length(value):
+        calls.append(value)
+        return len(value)
+
+    with pytest.raises(TypeError):
+        length(None)
+    assert calls == [None]
+    assert length(['a']) == 1 and length('ab') == 2 and length('ab') == 2
+    assert calls == [None, ['a'], 'ab']
+
+
+def test_remove_symbol():
+    """ Test symbols are removed like the chained replaces did """
+    assert remove_symbol('a"b\\c“d\r\ne\nf\rg\\N') == 'abcdef\rgN'
+    assert remove_symbol('\r"\n') == ''
+    assert remove_symbol(12) == '12'
+    assert remove_symbol(True) == 'True'
+    assert remove_symbol(None) == ''
+
+
+def test_field_mapping():
+    """ Test field mappings give the same values as jinja expressions """
+    env = get_jinja_env('.')
+    spec = {
+        'product_id': 'data.id',
+        'title': "data['title'] | remove_symbol",
+        'image': 'data.images[1] | fix_url',
+        'size': 'data.attrs.size',
+        'label': "data.title | upper",
+        'missing': 'data.missing',
+        'published': True,
+        'custom_attributes': {'tags': ['data.tags[0]', "'fixed'"]},
+        'first_tag': 'data.tags.0',
+        'zero': 'data.attrs.0',
+    }
+    data = {'id': 'P1', 'title': 'A "quoted" title', 'images': ['a.jpg', 'http://x.com/b c.jpg'],
+            'attrs': {'size': 'L', '0': 'zero'}, 'tags': ['new']}
+    mapping = FieldMapping(spec, env)
+    expected = {key: env.compile_expression(value)(data=data) for key, value in spec.items()
+                if isinstance(value, str)}
+    expected['published'] = True
+    expected['custom_attributes'] = {'tags': ['new', 'fixed']}
+    assert mapping.render_object(data) == expected
+    assert expected['image'] == 'http://x.com/b%20c.jpg'
+    assert expected['missing'] is None
+    assert expected['first_tag'] == 'new' and expected['zero'] is None
+    # undefined parents give None instead of an error
+    assert FieldMapping({'deeper': 'data.missing.deeper'}, env).render_object(data) == {'deeper': None}
@@ -0,0 +1,114 @@
+""" Test writing to several Miso destinations """
+import json
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from target_miso.fan_out import CheckpointMerger, Tee
+from target_miso.fingerprint import fingerprint
+from target_miso.py_extensions import import_code
+from target_miso.target import Destination, fan_out_messages
+from target_miso.upload_state import DictUploadState, SqliteUploadState
+
+
+def test_tee():
+    """ Test every consumer gets every item, and a failing consumer stops the others """
+    assert Tee(3, max_pending=2).run(range(100), lambda index, items: sum(items)) == [4950] * 3
+
+    def consume(index, items):
+        for item in items:
+            if index == 1 and item == 10:
+                raise ValueError('broken destination')
+        return index
+
+    with pytest.raises(ValueError):
+        Tee(2, max_pending=2).run(range(100000), consume)
+
+
+def test_checkpoint_merger_held():
+    """ Test a checkpoint is emitted once every destination reached it, and dropped when one holds it """
+    emit = MagicMock()
+    merger = CheckpointMerger(['a', 'b'], emit)
+    emit_a, emit_b = merger.emitter('a'), merger.emitter('b')
+    emit_a({'position': 1, 'a': 1})
+    emit_b(None)
+    emit_a({'position': 2, 'a': 2})
+    emit.assert_not_called()
+    emit_b({'position': 2, 'b': 2})
+    emit.assert_called_once_with({'position': 2, 'a': 2, 'b': 2})
+
+
+def test_fan_out_messages(capsys):
+    """ Test records are transformed once and written to each destination with its own upload state """
+    pyfn = MagicMock(wraps=import_code(
+"""
+def transform(x):
+    return {'product_id': str(x['id'])}
+""", 'test_fan_out'))
+    destinations = []
+    for name in ('prod', 'staging'):
+        upload_state = DictUploadState()
+        if name == 'staging':
+            # already uploaded to staging
+            upload_state.set('fan_out_stream', '0', fingerprint({'product_id': '0'}))
+        destinations.append(Destination(name, MagicMock(), lambda upload_state=upload_state: upload_state, {}))
+    messages = []
+    for i in range(4):
+        messages.append(json.dumps({"type": "RECORD", "stream": "fan_out_stream", "record": {"id": i}}))
+        messages.append(json.dumps({"type": "STATE", "value": {"position": i}}))
+    state = fan_out_messages(messages, destinations, {}, {}, {'fan_out_stream': pyfn}, {'state_every_records': 2},
+                             max_pending=1)
+    assert pyfn.call_count == 4
+    prod, staging = destinations
+    assert prod.miso_client.write_record.call_count == 4
+    assert staging.miso_client.write_record.call_count == 3
+    assert state['position'] == 3
+    assert sorted(state['__miso_target_state__:prod']['fan_out_stream']) == ['0', '1', '2', '3']
+    assert sorted(state['__miso_target_state__:staging']['fan_out_stream']) == ['0', '1', '2', '3']
+    checkpoints = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [c['position'] for c in checkpoints] == [1, 3]
+    assert sorted(checkpoints[0]['__miso_target_state__:prod']['fan_out_stream']) == ['0', '1']
+    assert '__miso_target_state__:staging' in checkpoints[0]
+
+
+def test_fan_out_messages_sqlite(tmp_path):
+    """ Test the SQLite upload state of each destination is opened and used in its own thread """
+    pyfn = import_code(
+"""
+def transform(x):
+    return {'product_id': str(x['id'])}
+""", 'test_fan_out_sqlite')
+    destinations = [Destination(name, MagicMock(), lambda name=name: SqliteUploadState(tmp_path / f'{name}.db'), {})
+                    for name in ('prod', 'staging')]
+    messages = [json.dumps({"type": "RECORD", "stream": "fan_out_stream", "record": {"id": i}}) for i in range(3)]
+    state = fan_out_messages(messages, destinations, {}, {}, {'fan_out_stream': pyfn}, {})
+    for destination in destinations:
+        assert destination.miso_client.write_record.call_count == 3
+        assert state[f'__miso_target_state__:{destination.name}']['backend'] == 'sqlite'
+        upload_state = SqliteUploadState(tmp_path / f'{destination.name}.db')
+        assert upload_state.get('fan_out_stream', '2') == fingerprint({'product_id': '2'})
+        upload_state.close()
+
+
+def test_fan_out_checkpoint_slow_destination(capsys):
+    """ Test a checkpoint only has the hashes of the records before it, while a fast destination goes on """
+    pyfn = import_code(
+"""
+def transform(x):
+    return {'product_id': str(x['id'])}
+""", 'test_fan_out_slow')
+    slow_client = MagicMock()
+    slow_client.write_record.side_effect = lambda *args: time.sleep(0.005)
+    destinations = [Destination('fast', MagicMock(), DictUploadState, {}),
+                    Destination('slow', slow_client, DictUploadState, {})]
+    messages = []
+    for i in range(50):
+        messages.append(json.dumps({"type": "RECORD", "stream": "fan_out_stream", "record": {"id": i}}))
+        messages.append(json.dumps({"type": "STATE", "value": {"position": i}}))
+    fan_out_messages(messages, destinations, {}, {}, {'fan_out_stream': pyfn}, {'state_every_records': 10})
+    checkpoints = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [c['position'] for c in checkpoints] == [9, 19, 29, 39, 49]
+    for checkpoint in checkpoints:
+        for name in ('fast', 'slow'):
+            assert len(checkpoint[f'__miso_target_state__:{name}']['fan_out_stream']) == checkpoint['position'] + 1
@@ -0,0 +1,33 @@
+""" Test record fingerprints """
+import simplejson as json
+
+from target_miso.fingerprint import canonical_json, fingerprint, is_same_record, legacy_md5
+from target_miso.target import is_upload_needed
+from target_miso.upload_state import DictUploadState
+
+
+def test_fingerprint():
+    """ Test fingerprints ignore the key order and are short """
+    record = {'product_id': 'a', 'title': 'Café', 'tags': [1, 2.5, None, True]}
+    shuffled = {'tags': [1, 2.5, None, True], 'title': 'Café', 'product_id': 'a'}
+    assert fingerprint(record) == fingerprint(shuffled)
+    assert fingerprint(record).startswith('b2:') and len(fingerprint(record)) == 19
+    assert fingerprint(record, 'md5') == legacy_md5(record)
+    changed = {**record, 'title': 'Cafe'}
+    assert not is_same_record(fingerprint(record), changed, fingerprint(changed))
+
+
+def test_fingerprint_non_str_keys():
+    """ Test records with int keys and exponent floats are fingerprinted like their JSON """
+    record = {'product_id': 'a', 'attrs': {1: 'a', 'b': 2}, 'score': 1e-7}
+    assert json.loads(canonical_json(record)) == {'product_id': 'a', 'attrs': {'1': 'a', 'b': 2}, 'score': 1e-7}
+    assert fingerprint(record) == fingerprint({'product_id': 'a', 'attrs': {'1': 'a', 'b': 2}, 'score': 1e-7})
+
+
+def test_migrate_md5_state():
+    """ Test md5 hashes from an older state are replaced when a record is unchanged """
+    record = {'product_id': 'a', 'title': 'title'}
+    upload_state = DictUploadState({'s': {'a': legacy_md5(record)}})
+    assert not is_upload_needed(upload_state, 's', 'a', record)
+    assert upload_state.get('s', 'a') == fingerprint(record)
+    assert is_upload_needed(upload_state, 's', 'a', {**record, 'title': 'new title'})
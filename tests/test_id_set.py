@@ -0,0 +1,20 @@
+""" Test the spilling id set """
+import random
+
+from target_miso.id_set import IdSet
+
+
+def test_id_set_difference():
+    """ Test the difference is the same as with python sets """
+    rand = random.Random(42)
+    seen_ids = [f'id-{rand.randrange(5000)}' for _ in range(3000)]
+    existing_ids = [f'id-{rand.randrange(5000)}' for _ in range(4000)]
+    seen, existing = IdSet(max_in_memory=100), IdSet(max_in_memory=100)
+    seen.update(seen_ids)
+    existing.update(existing_ids)
+    assert len(seen.runs) == 30
+    assert list(existing.difference(seen)) == sorted(set(existing_ids) - set(seen_ids))
+    assert list(seen) == sorted(set(seen_ids))
+    seen.close()
+    existing.close()
+    assert not seen
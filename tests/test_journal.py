@@ -0,0 +1,41 @@
+""" Test the batch journal """
+from unittest.mock import MagicMock
+
+from requests import ConnectionError
+
+from target_miso.journal import BatchJournal
+from target_miso.miso import MisoWriter
+
+
+def test_journal_ack_and_replay(tmp_path):
+    """ Test acknowledged batches are dropped and failed ones are uploaded again by the next run """
+    client = MisoWriter(api_server='https://test.com', api_key='secret', use_async=False,
+                        write_record_limit=2, journal=BatchJournal(tmp_path), max_retries=0)
+    client.session = MagicMock()
+    client.session.post.side_effect = [MagicMock(), ConnectionError('down'), MagicMock()]
+    for i in range(5):
+        client.write_record({'product_id': str(i)})
+    client.close()
+    # the failed batch, and the record still buffered when the process stopped
+    assert [path.name for path in BatchJournal(tmp_path).pending()] == \
+        ['000000000001.products.segment', '000000000002.products.segment']
+
+    client = MisoWriter(api_server='https://test.com', api_key='secret', use_async=False,
+                        journal=BatchJournal(tmp_path))
+    client.session = MagicMock()
+    assert client.replay_journal() == 3
+    assert [call.kwargs['json'] for call in client.session.post.call_args_list] == [
+        {'data': [{'product_id': '2'}, {'product_id': '3'}]},
+        {'data': [{'product_id': '4'}]},
+    ]
+    assert BatchJournal(tmp_path).pending() == []
+
+
+def test_journal_truncated_segment(tmp_path):
+    """ Test a record cut by a crash is skipped """
+    (tmp_path / '000000000007.users.segment').write_bytes(b'{"user_id": "a"}\n{"user_id": "b"}\n{"user_')
+    journal = BatchJournal(tmp_path)
+    assert journal.sequence == 8
+    [(path, data_type, records)] = list(journal.replay())
+    assert data_type == 'users'
+    assert records == [{'user_id': 'a'}, {'user_id': 'b'}]
@@ -0,0 +1,52 @@
+""" Test memory accounting and limits """
+import sys
+from unittest.mock import MagicMock
+
+import pytest
+
+from target_miso.id_set import IdSet
+from target_miso.memory import MemoryLimitExceeded, MemoryMonitor, estimate_size, rss_bytes
+from target_miso.upload_state import DictUploadState
+
+
+def test_estimate_size():
+    """ Test sizes grow with the structures """
+    records = [{'product_id': str(i), 'title': 'x' * 100} for i in range(1000)]
+    assert estimate_size(records, records, len(records)) > 100 * 1000
+    ids = IdSet()
+    ids.update(str(i) for i in range(1000))
+    assert ids.memory_size() > 1000 * 40
+    ids.spill()
+    assert not ids.runs
+    ids.spill(min_ids=1000)
+    assert ids.memory_size() < 100 and len(ids) == 1000
+    ids.close()
+    upload_state = DictUploadState()
+    upload_state.set('s', 'a', 'b2:0123456789abcdef')
+    assert upload_state.memory_size() > 0
+
+
+def test_rss_bytes_without_resource(monkeypatch):
+    """ Test the RSS is unknown where the resource module is missing """
+    monkeypatch.setitem(sys.modules, 'resource', None)
+    assert rss_bytes() == 0
+
+
+def test_memory_limits():
+    """ Test memory is released above the limit and the run stops above the hard limit """
+    sizes = MagicMock(return_value={'buffer:products': 10})
+    release = MagicMock()
+    monitor = MemoryMonitor(limit_mb=1, check_every=2)
+    monitor.tick(sizes, release)
+    release.assert_not_called()
+    monitor.tick(sizes, release)
+    release.assert_called_once_with()
+    # not again before release_interval
+    monitor.tick(sizes, release)
+    monitor.tick(sizes, release)
+    release.assert_called_once_with()
+    assert rss_bytes() > 1024 * 1024
+
+    monitor = MemoryMonitor(hard_limit_mb=1)
+    with pytest.raises(MemoryLimitExceeded, match='buffer:products'):
+        monitor.check(sizes, release)
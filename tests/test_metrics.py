@@ -0,0 +1,28 @@
+""" Test metrics """
+from target_miso.metrics import Metrics
+
+
+def test_metrics():
+    """ Test counters, histograms and peaks are merged and exported """
+    metrics = Metrics()
+    metrics.incr('records_uploaded', 100, data_type='products')
+    metrics.observe('http_request', 0.2, endpoint='products')
+    metrics.peak('buffer_peak', 10, data_type='products')
+    metrics.peak('buffer_peak', 5, data_type='products')
+
+    worker = Metrics()
+    worker.incr('records_uploaded', 50, data_type='products')
+    worker.observe('http_request', 3, endpoint='products')
+    metrics.merge(worker.drain())
+    assert not worker.counters
+
+    assert metrics.get('records_uploaded', data_type='products') == 150
+    points = {point['metric']: point for point in metrics.summary()}
+    assert points['http_request']['tags'] == {'endpoint': 'products', 'count': 2}
+    assert points['buffer_peak']['value'] == 10
+
+    text = metrics.to_prometheus()
+    assert 'target_miso_records_uploaded_total{data_type="products"} 150.0' in text
+    assert 'target_miso_http_request_seconds_bucket{endpoint="products",le="0.25"} 1' in text
+    assert 'target_miso_http_request_seconds_bucket{endpoint="products",le="+Inf"} 2' in text
+    assert '# TYPE target_miso_buffer_peak gauge' in text
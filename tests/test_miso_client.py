@@ -1,11 +1,18 @@
+import gzip
+import json
+import time
 from unittest.mock import MagicMock
 
-from target_miso.miso import MisoWriter
+from requests import HTTPError
+
+from target_miso.miso import MisoWriter, BatchLimit, DeadLetterFile, encode_record, iter_ids
 
 
 def test_write_and_flush():
     """ Test write and flush """
-    client = MisoWriter(api_server='https://test.com', api_key='secret', use_async=False)
+    # the same record over and over, which would be coalesced into one
+    client = MisoWriter(api_server='https://test.com', api_key='secret', use_async=False,
+                        write_record_limit=200, coalesce_records=False)
     client.session = MagicMock()
     client.session.post = MagicMock()
     product = {'product_id': 'test'}
@@ -45,3 +52,186 @@ def test_write_and_flush():
         'https://test.com/v1/users?api_key=secret', json={'data': [user]}
     )
 
+
+def test_concurrent_write_and_flush():
+    """ Test batches are sent concurrently and flush waits for all of them """
+    client = MisoWriter(api_server='https://test.com', api_key='secret', use_async=False,
+                        write_record_limit=10, max_in_flight=4)
+    client.session = MagicMock()
+    for i in range(95):
+        client.write_record({'product_id': str(i)})
+    client.flush()
+    assert client.session.post.call_count == 10
+    sent = [rec['product_id']
+            for call in client.session.post.call_args_list
+            for rec in call.kwargs['json']['data']]
+    assert sorted(sent, key=int) == [str(i) for i in range(95)]
+    assert not client.type_to_futures
+    client.close()
+
+
+def test_concurrent_same_id_in_order():
+    """ Test a batch with a newer version of an in-flight product waits for the older one """
+    client = MisoWriter(api_server='https://test.com', api_key='secret', use_async=False,
+                        write_record_limit=2, max_in_flight=4)
+    landed = []
+
+    def post(url, json):
+        if json['data'][0]['version'] == 1:
+            time.sleep(0.1)
+        landed.extend((rec['product_id'], rec['version']) for rec in json['data'])
+        return MagicMock(status_code=200)
+
+    client.session = MagicMock()
+    client.session.post.side_effect = post
+    for record in [('a', 1), ('b', 1), ('a', 2), ('c', 1), ('d', 2), ('e', 2)]:
+        client.write_record({'product_id': record[0], 'version': record[1]})
+    client.flush()
+    assert landed.index(('a', 1)) < landed.index(('a', 2))
+    assert sorted(landed) == [('a', 1), ('a', 2), ('b', 1), ('c', 1), ('d', 2), ('e', 2)]
+    client.close()
+
+
+def test_gzip_payload():
+    """ Test batches are posted as gzip-compressed JSON """
+    client = MisoWriter(api_server='https://test.com', api_key='secret', use_async=False,
+                        payload_encoding='gzip')
+    client.session = MagicMock()
+    products = [{'product_id': str(i), 'title': 'title ' * 50} for i in range(10)]
+    for product in products:
+        client.write_record(product)
+    client.flush()
+    kwargs = client.session.post.call_args.kwargs
+    assert kwargs['headers']['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(kwargs['data'])) == {'data': products}
+    requests, raw_size, sent_size = client.type_to_payload_size['products']
+    assert requests == 1
+    assert raw_size == len(gzip.decompress(kwargs['data']))
+    assert sent_size == len(kwargs['data']) < raw_size
+
+
+def test_batch_limits():
+    """ Test batches are sent by size and by age """
+    client = MisoWriter(api_server='https://test.com', api_key='secret', use_async=False,
+                        batch_limits={'products': BatchLimit(max_records=100, max_bytes=1000),
+                                      'users': BatchLimit(max_records=100, max_age=0)})
+    client.session = MagicMock()
+    for i in range(10):
+        client.write_record({'product_id': str(i), 'title': 'x' * 200})
+    batches = [call.kwargs['json']['data'] for call in client.session.post.call_args_list]
+    assert [len(batch) for batch in batches] == [4, 4]
+    assert all(len(json.dumps(batch)) <= 1000 for batch in batches)
+
+    client.session = MagicMock()
+    client.write_record({'user_id': 'test'})
+    client.session.post.assert_called_once_with('https://test.com/v1/users?api_key=secret',
+                                                json={'data': [{'user_id': 'test'}]})
+
+
+def test_iter_ids():
+    """ Test ids are parsed from a response body cut into small chunks """
+    ids = ['a', 'b\\"c', 'é', 'd' * 20] + [str(i) for i in range(100)]
+    body = json.dumps({'message': 'success', 'data': {'ids': ids}}).encode()
+    for size in (1, 3, 7, len(body)):
+        chunks = [body[i:i + size] for i in range(0, len(body), size)]
+        assert list(iter_ids(chunks)) == ids
+    assert list(iter_ids([b'{"data": {"ids": []}}'])) == []
+
+
+def test_get_existing_ids():
+    """ Test ids are streamed from the _ids API """
+    client = MisoWriter(api_server='https://test.com', api_key='secret', use_async=False)
+    client.session = MagicMock()
+    response = client.session.get.return_value.__enter__.return_value
+    response.iter_content.return_value = [b'{"data": {"ids": ["a", ', b'"b"]}}']
+    assert list(client.get_existing_ids('products')) == ['a', 'b']
+    client.session.get.assert_called_once_with('https://test.com/v1/products/_ids?api_key=secret', stream=True)
+
+
+def test_chunked_delete():
+    """ Test deletes are sent in chunks and failed chunks are not reported as deleted """
+    client = MisoWriter(api_server='https://test.com', api_key='secret', use_async=False,
+                        max_in_flight=3, delete_chunk_size=10, delete_retries=0)
+    client.session = MagicMock()
+
+    def post(url, json):
+        response = MagicMock()
+        if '13' in json['data']['product_ids']:
+            response.raise_for_status.side_effect = HTTPError('500 Server Error')
+        return response
+
+    client.session.post.side_effect = post
+    ids = [str(i) for i in range(25)]
+    deleted_ids = client.delete_records(ids, 'products')
+    assert client.session.post.call_count == 3
+    assert sorted(deleted_ids, key=int) == ids[:10] + ids[20:]
+
+
+def test_rejected_records(tmp_path):
+    """ Test a batch is sent again without the invalid records, which go to the dead-letter file """
+    client = MisoWriter(api_server='https://test.com', api_key='secret', use_async=False,
+                        dead_letter=DeadLetterFile(tmp_path / 'dead_letter.jsonl'))
+    client.session = MagicMock()
+
+    def post(url, json):
+        response = MagicMock(status_code=200)
+        bad = [i for i, record in enumerate(json['data']) if record['product_id'] in ('3', '7')]
+        if bad and len(json['data']) > 4:
+            # the error is not mapped to the records
+            response.status_code = 413
+            response.text = 'Payload too large'
+        elif bad:
+            response.status_code = 422
+            response.text = '{"errors": true, "message": "data.%s.title: Invalid value"}' % bad[0]
+        if response.status_code != 200:
+            response.raise_for_status.side_effect = HTTPError(response=response)
+        return response
+
+    client.session.post.side_effect = post
+    client._send_request([{'product_id': str(i)} for i in range(10)], 'products')
+    uploaded = [record['product_id'] for call in client.session.post.call_args_list
+                if call.kwargs['json']['data'] and post(None, call.kwargs['json']).status_code == 200
+                for record in call.kwargs['json']['data']]
+    assert sorted(uploaded, key=int) == ['0', '1', '2', '4', '5', '6', '8', '9']
+    rejected = [json.loads(line) for line in (tmp_path / 'dead_letter.jsonl').read_text().splitlines()]
+    assert [r['record'] for r in rejected] == [{'product_id': '3'}, {'product_id': '7'}]
+    assert rejected[0]['data_type'] == 'products'
+    assert 'data.1.title' in rejected[0]['error']
+
+
+def test_coalesce_records():
+    """ Test a buffered product or user is replaced by its newer version """
+    client = MisoWriter(api_server='https://test.com', api_key='secret', use_async=False)
+    client.session = MagicMock()
+    for i in range(3):
+        client.write_record({'product_id': 'a', 'title': str(i)})
+        client.write_record({'product_id': str(i)})
+    interaction = {'user_id': 'u', 'type': 'add_to_cart'}
+    client.write_record(interaction)
+    client.write_record(interaction)
+    client.flush()
+    data = {call.args[0].split('/')[-1].split('?')[0]: call.kwargs['json']['data']
+            for call in client.session.post.call_args_list}
+    assert data['products'] == [{'product_id': 'a', 'title': '2'}, {'product_id': '0'},
+                                {'product_id': '1'}, {'product_id': '2'}]
+    assert data['interactions'] == [interaction, interaction]
+
+
+def test_coalesce_records_bytes():
+    """ Test the size of a replaced record is taken off the buffer bytes """
+    client = MisoWriter(api_server='https://test.com', api_key='secret', use_async=False,
+                        batch_limits={'products': BatchLimit(100, max_bytes=2000)})
+    client.session = MagicMock()
+    for i in range(50):
+        client.write_record({'product_id': 'a', 'title': 'x' * 40, 'version': i})
+    client.session.post.assert_not_called()
+    client.write_record({'product_id': 'a', 'title': 'x' * 4000})
+    client.session.post.assert_called_once()
+    assert client.type_to_buffer_bytes['products'] == 0
+    client.flush()
+
+
+def test_encode_record_non_str_keys():
+    """ Test records with int keys and exponent floats are serialized """
+    record = {'product_id': 'a', 'attrs': {1: 'a'}, 'score': 1e-7}
+    assert json.loads(encode_record(record)) == {'product_id': 'a', 'attrs': {'1': 'a'}, 'score': 1e-7}
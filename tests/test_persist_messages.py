@@ -3,9 +3,14 @@ import json
 from pathlib import Path
 from unittest.mock import MagicMock
 
-from target_miso.extensions import get_jinja_env
+from requests import HTTPError
+
+from target_miso.extensions import get_jinja_env, load_field_mapping
+from target_miso.journal import BatchJournal
+from target_miso.miso import MisoWriter
 from target_miso.py_extensions import import_code
 from target_miso.target import persist_messages
+from target_miso.upload_state import DictUploadState, SqliteUploadState
 
 def test_persist_message():
     """ Test persist message function is working as expected """
@@ -32,7 +37,8 @@ def test_persist_message():
         {
             "product_id": "123",
             "title": 'title 123'
-        }
+        },
+        'products'
     )
     dummy_client.flush.assert_called_once_with()
 
@@ -59,7 +65,28 @@ def test_persist_message_jinja():
     dummy_client.write_record.assert_called_once_with(
         {'user_id': '123', 'type': 'product_detail_page_view',
          'timestamp': '2022-03-26T18:45:53+00:00',
-         'product_ids': ['title 123']})
+         'product_ids': ['title 123']}, 'interactions')
+    dummy_client.flush.assert_called_once_with()
+
+
+def test_persist_message_field_mapping():
+    """ Test field mapping templates render Miso records without JSON text """
+    dummy_client = MagicMock()
+    raw_rec = {"user_id": 123, "product_id": "title 123",
+               "timestamp": "2022-03-26T18:45:53+00:00"}
+    jinja_env = get_jinja_env(template_path)
+
+    persist_messages(
+        [json.dumps({"type": "RECORD", "stream": "test_stream", "record": raw_rec})],
+        dummy_client,
+        {},
+        {'test_stream': load_field_mapping(template_path / 'interaction.fields.json', jinja_env)},
+        {}
+    )
+    dummy_client.write_record.assert_called_once_with(
+        {'user_id': '123', 'type': 'product_detail_page_view',
+         'timestamp': '2022-03-26T18:45:53+00:00',
+         'product_ids': ['title 123']}, 'interactions')
     dummy_client.flush.assert_called_once_with()
 
 
@@ -91,5 +118,195 @@ def transform(x):
          'product_ids': ['title 123'],
          'timestamp': '2022-03-26T18:45:53+00:00',
          'type': 'product_detail_page_view'
-         })
+         }, 'interactions')
     dummy_client.flush.assert_called_once_with()
+
+
+def test_persist_message_multiprocess():
+    """ Test records transformed in worker processes keep their order """
+    dummy_client = MagicMock()
+    pyfn = import_code(
+"""
+def transform(x):
+    return {'product_id': str(x['id'])}
+""", 'test_mp')
+    messages = [json.dumps({"type": "RECORD", "stream": "test_stream", "record": {"id": i}}) for i in range(50)]
+    messages.insert(20, json.dumps({"type": "STATE", "value": {"bookmark": 20}}))
+    state = persist_messages(
+        messages,
+        dummy_client,
+        {},
+        {},
+        {'test_stream': pyfn},
+        {'transform_workers': 2, 'transform_chunk_size': 7}
+    )
+    written = [call.args[0]['product_id'] for call in dummy_client.write_record.call_args_list]
+    assert written == [str(i) for i in range(50)]
+    assert state['bookmark'] == 20
+
+
+def test_persist_message_activate_version():
+    """ Test records missing from a full sync are deleted from Miso """
+    dummy_client = MagicMock()
+    dummy_client.get_existing_ids = MagicMock(return_value=['1', '2', '5', '7'])
+    pyfn = import_code(
+"""
+def transform(x):
+    return {'product_id': str(x['id'])}
+""", 'test_av')
+    messages = [json.dumps({"type": "RECORD", "stream": "av_stream", "record": {"id": i}}) for i in range(5)]
+    messages.insert(0, json.dumps({"type": "STATE", "value": {
+        "__miso_target_state__": {"av_stream": {"5": "hash", "7": "hash"}}}}))
+    messages.append(json.dumps({"type": "ACTIVATE_VERSION", "stream": "av_stream", "version": 1}))
+    # only the chunk of id 5 was deleted
+    dummy_client.delete_records = MagicMock(return_value=['5'])
+    state = persist_messages(messages, dummy_client, {}, {}, {'av_stream': pyfn},
+                             {'max_ids_in_memory': 2})
+    dummy_client.delete_records.assert_called_once_with(['5', '7'], 'products')
+    assert sorted(state['__miso_target_state__']['av_stream']) == ['0', '1', '2', '3', '4', '7']
+
+
+def test_persist_message_py_batch():
+    """ Test python templates with transform_batch get lists of records """
+    dummy_client = MagicMock()
+    pyfn = import_code(
+"""
+batches = []
+
+def transform_batch(records):
+    batches.append(len(records))
+    return [{'product_id': str(x['id'])} if x['id'] != 3 else None for x in records]
+""", 'test_batch')
+    messages = [json.dumps({"type": "RECORD", "stream": "batch_stream", "record": {"id": i}}) for i in range(7)]
+    persist_messages(messages, dummy_client, {}, {}, {'batch_stream': pyfn}, {'transform_batch_size': 3})
+    assert pyfn.transform_batch.__globals__['batches'] == [3, 3, 1]
+    written = [call.args[0]['product_id'] for call in dummy_client.write_record.call_args_list]
+    assert written == ['0', '1', '2', '4', '5', '6']
+
+
+def test_persist_message_unchanged_users():
+    """ Test unchanged users are skipped like products """
+    dummy_client = MagicMock()
+    pyfn = import_code(
+"""
+def transform(x):
+    return {'user_id': str(x['id']), 'city': x['city']}
+""", 'test_users')
+    records = [{"id": 1, "city": "Taipei"}, {"id": 2, "city": "Berlin"}, {"id": 1, "city": "Taipei"}]
+    messages = [json.dumps({"type": "RECORD", "stream": "users_stream", "record": r}) for r in records]
+    state = persist_messages(messages, dummy_client, {}, {}, {'users_stream': pyfn})
+    assert dummy_client.write_record.call_count == 2
+    assert sorted(state['__miso_target_state__']['users_stream']) == ['1', '2']
+
+
+def test_persist_message_checkpoints(capsys):
+    """ Test STATE is emitted during the run, after the records before it are flushed """
+    dummy_client = MagicMock()
+    pyfn = import_code(
+"""
+def transform(x):
+    return {'product_id': str(x['id'])}
+""", 'test_checkpoints')
+    messages = []
+    for i in range(6):
+        messages.append(json.dumps({"type": "RECORD", "stream": "checkpoint_stream", "record": {"id": i}}))
+        messages.append(json.dumps({"type": "STATE", "value": {"position": i}}))
+    persist_messages(messages, dummy_client, {}, {}, {'checkpoint_stream': pyfn}, {'state_every_records': 3})
+    states = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [s['position'] for s in states] == [2, 5]
+    assert sorted(states[0]['__miso_target_state__']['checkpoint_stream']) == ['0', '1', '2']
+    assert dummy_client.flush.call_count == 3
+
+
+def test_persist_message_checkpoints_failed_batch(capsys, tmp_path):
+    """ Test checkpoints are held after a failed batch, unless its records are in the journal """
+    pyfn = import_code(
+"""
+def transform(x):
+    return {'product_id': str(x['id'])}
+""", 'test_checkpoints_failed')
+    messages = []
+    for i in range(4):
+        messages.append(json.dumps({"type": "RECORD", "stream": "checkpoint_stream", "record": {"id": i}}))
+        messages.append(json.dumps({"type": "STATE", "value": {"position": i}}))
+
+    def post(url, **kwargs):
+        response = MagicMock(status_code=500 if client.session.post.call_count == 1 else 200, headers={})
+        if response.status_code == 500:
+            response.raise_for_status.side_effect = HTTPError(response=response)
+        return response
+
+    for journal in (None, BatchJournal(tmp_path)):
+        client = MisoWriter(api_server='https://test.com', api_key='secret', use_async=False, max_retries=0,
+                            rate_limit={'min_rate': 1000}, journal=journal)
+        client.session = MagicMock()
+        client.session.post.side_effect = post
+        persist_messages(messages, client, {}, {}, {'checkpoint_stream': pyfn}, {'state_every_records': 2})
+        assert client.failed_batches == 1
+        states = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+        assert [s['position'] for s in states] == ([] if journal is None else [1, 3])
+        client.close()
+
+
+def test_persist_message_final_state_failed_batch(capsys, tmp_path):
+    """ Test the final state is not emitted after a failed batch without a journal, and the hashes of
+    the records after the last checkpoint are not kept """
+    pyfn = import_code(
+"""
+def transform(x):
+    return {'product_id': str(x['id'])}
+""", 'test_final_state_failed')
+    messages = []
+    for i in range(6):
+        messages.append(json.dumps({"type": "RECORD", "stream": "final_stream", "record": {"id": i}}))
+        messages.append(json.dumps({"type": "STATE", "value": {"position": i}}))
+
+    def post(url, **kwargs):
+        response = MagicMock(status_code=500 if client.session.post.call_count == 2 else 200, headers={})
+        if response.status_code == 500:
+            response.raise_for_status.side_effect = HTTPError(response=response)
+        return response
+
+    for upload_state in (DictUploadState(), SqliteUploadState(tmp_path / 'state.db')):
+        client = MisoWriter(api_server='https://test.com', api_key='secret', use_async=False, max_retries=0,
+                            rate_limit={'min_rate': 1000})
+        client.session = MagicMock()
+        client.session.post.side_effect = post
+        # what main emits at the end
+        assert persist_messages(messages, client, {}, {}, {'final_stream': pyfn}, {'state_every_records': 2},
+                                upload_state) is None
+        states = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+        assert [s['position'] for s in states] == [1]
+        if isinstance(upload_state, DictUploadState):
+            assert sorted(states[0]['__miso_target_state__']['final_stream']) == ['0', '1']
+        upload_state.close()
+    assert sorted(states[0]['__miso_target_state__']) == ['backend', 'path', 'version']
+    upload_state = SqliteUploadState(tmp_path / 'state.db')
+    assert [upload_state.get('final_stream', str(i)) is not None for i in range(6)] == [True] * 2 + [False] * 4
+    upload_state.close()
+
+
+def test_persist_message_stream_plan():
+    """ Test the data type of a stream is worked out again when its records change """
+    dummy_client = MagicMock()
+    pyfn = import_code(
+"""
+import datetime
+
+def transform(x):
+    if x['kind'] == 'user':
+        return {'user_id': x['id']}
+    if x['kind'] == 'interaction':
+        return {'user_id': x['id'], 'type': 'product_detail_page_view'}
+    return {'product_id': x['id'], 'updated_at': datetime.datetime(2022, 3, 1, 10, 0, 0, 123)}
+""", 'test_plan')
+    records = [{"id": "p", "kind": "product"}, {"id": "u", "kind": "user"}, {"id": "i", "kind": "interaction"},
+               {"id": "p2", "kind": "product"}]
+    messages = [json.dumps({"type": "RECORD", "stream": "plan_stream", "record": r}) for r in records]
+    persist_messages(messages, dummy_client, {}, {}, {'plan_stream': pyfn})
+    assert [call.args for call in dummy_client.write_record.call_args_list] == [
+        ({'product_id': 'p', 'updated_at': '2022-03-01T10:00:00+00:00'}, 'products'),
+        ({'user_id': 'u'}, 'users'),
+        ({'user_id': 'i', 'type': 'product_detail_page_view'}, 'interactions'),
+        ({'product_id': 'p2', 'updated_at': '2022-03-01T10:00:00+00:00'}, 'products'),
+    ]
@@ -0,0 +1,75 @@
+""" Test the adaptive rate limiter and the retries """
+import time
+from unittest.mock import MagicMock
+
+from target_miso.miso import MisoWriter
+from target_miso.rate_limit import AdaptiveRateLimiter, RetryBudget, parse_retry_after
+
+
+def response(status_code, headers=None):
+    res = MagicMock(status_code=status_code, ok=status_code < 400, headers=headers or {})
+    return res
+
+
+def test_parse_retry_after():
+    """ Test Retry-After in seconds and as a date """
+    assert parse_retry_after('3') == 3
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+    assert parse_retry_after('soon') is None
+    assert parse_retry_after(None) is None
+
+
+def test_aimd():
+    """ Test the rate halves on throttling, once per overload, and grows back additively """
+    limiter = AdaptiveRateLimiter(initial_rate=10, max_rate=11)
+    limiter.on_throttle()
+    limiter.on_throttle()
+    assert limiter.rate == 5
+    for _ in range(10):
+        limiter.on_success(0.1)
+    assert 6.5 < limiter.rate < 7
+    for _ in range(100):
+        limiter.on_success(0.1)
+    assert limiter.rate == 11
+    limiter = AdaptiveRateLimiter(initial_rate=10, target_latency=0.5)
+    limiter.on_success(1)
+    assert limiter.rate == 5
+
+
+def test_max_rate():
+    """ Test requests are paced at max_rate from the first one """
+    limiter = AdaptiveRateLimiter(max_rate=20)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.19
+    limiter.on_success(0.1)
+    assert limiter.rate == 20
+
+
+def test_retry_budget():
+    """ Test retries are limited to a share of the requests """
+    budget = RetryBudget(ratio=0.5, min_retries=1)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw()
+
+
+def test_retries():
+    """ Test throttled requests are retried and authentication failures are not """
+    client = MisoWriter(api_server='https://test.com', api_key='secret', use_async=False, backoff_factor=0,
+                        rate_limit={'min_rate': 1000})
+    client.session = MagicMock()
+    client.session.post.side_effect = [response(429, {'Retry-After': '0'}), response(503), response(200)]
+    assert client._request('post', 'products', 'https://test.com/v1/products', json={}).status_code == 200
+    assert client.session.post.call_count == 3
+    assert client.rate_limiter('products').rate is not None
+
+    client.session.post.side_effect = [response(401), response(200)]
+    assert client._request('post', 'users', 'https://test.com/v1/users', json={}).status_code == 401
+
+    client.session.post.side_effect = [response(500)] * 5
+    assert client._request('post', 'users', 'https://test.com/v1/users', json={}).status_code == 500
+    assert client.session.post.call_count == 3 + 1 + 4
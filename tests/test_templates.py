@@ -0,0 +1,30 @@
+""" Test lazy template loading and the compiled code cache """
+from pathlib import Path
+from unittest.mock import MagicMock
+
+from target_miso.py_extensions import import_code_path
+from target_miso.templates import LazyTemplates
+
+
+def test_lazy_templates():
+    """ Test a template is loaded once, the first time its stream needs it """
+    load = MagicMock(side_effect=lambda path: path.name)
+    templates = LazyTemplates({'a': Path('a.py'), 'b': Path('b.py')}, load)
+    assert 'a' in templates and 'c' not in templates
+    assert sorted(templates) == ['a', 'b']
+    load.assert_not_called()
+    assert templates['a'] == templates['a'] == 'a.py'
+    load.assert_called_once_with(Path('a.py'))
+
+
+def test_code_cache(tmp_path):
+    """ Test python templates are compiled once per source """
+    path = tmp_path / 'stream.py'
+    path.write_text("def transform(x):\n    return {'product_id': x['id']}\n")
+    cache_folder = tmp_path / 'cache'
+    assert import_code_path(path, cache_folder)({'id': 'a'}) == {'product_id': 'a'}
+    [cached] = cache_folder.iterdir()
+    assert import_code_path(path, cache_folder)({'id': 'b'}) == {'product_id': 'b'}
+    path.write_text("def transform(x):\n    return {'user_id': x['id']}\n")
+    assert import_code_path(path, cache_folder)({'id': 'c'}) == {'user_id': 'c'}
+    assert len(list(cache_folder.iterdir())) == 2
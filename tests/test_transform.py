@@ -1,5 +1,10 @@
 """ Test eval jsonnet """
+import json
+
+import pytest
+
 from target_miso.target import eval_jsonnet
+from target_miso.transform import RecordTransformer, compile_jsonnet, parse_messages, transform_messages
 
 
 def test_transform():
@@ -30,3 +35,34 @@ def test_transform():
     assert output == {"product_id": "123",
                       "title": 'title 123',
                       "custom_attributes": raw_rec}
+
+
+def test_transform_batch():
+    """ Test batched jsonnet transformation keeps the message order """
+    template = """
+        local title = data.asset_title;
+        { product_id: std.toString(data.asset_id), title: title }
+    """
+    transformer = RecordTransformer({'s': template}, {}, {})
+    records = [{"asset_id": i, "asset_title": f"title {i}"} for i in range(5)]
+    assert compile_jsonnet(template).evaluate_batch(records) == [eval_jsonnet(template, r) for r in records]
+
+    msg_objs = [{'type': 'RECORD', 'stream': 's', 'record': r} for r in records]
+    msg_objs.insert(3, {'type': 'STATE', 'value': {'bookmark': 3}})
+    output = list(transform_messages(msg_objs, transformer, batch_size=2))
+    assert [m['type'] for m in output] == ['RECORD'] * 3 + ['STATE'] + ['RECORD'] * 2
+    assert [m['miso_record']['product_id'] for m in output if m['type'] == 'RECORD'] == \
+        ['0', '1', '2', '3', '4']
+
+
+def test_fast_parse():
+    """ Test the fast parser gives the same messages as singer """
+    messages = [
+        json.dumps({"type": "SCHEMA", "stream": "s", "schema": {"type": "object"}, "key_properties": ["id"]}),
+        json.dumps({"type": "RECORD", "stream": "s", "record": {"id": 1, "tags": ["a"], "price": 2.5}}),
+        json.dumps({"type": "STATE", "value": {"bookmarks": {"s": 1}}}),
+        json.dumps({"type": "ACTIVATE_VERSION", "stream": "s", "version": 1}),
+    ]
+    assert list(parse_messages(messages, fast=True)) == list(parse_messages(messages))
+    with pytest.raises(ValueError):
+        list(parse_messages(['{"type": "RECORD", '], fast=True))
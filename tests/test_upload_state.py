@@ -0,0 +1,56 @@
+""" Test upload state backends """
+from target_miso.upload_state import DictUploadState, SqliteUploadState
+
+
+def test_dict_upload_state():
+    """ Test hashes embedded in the Singer state """
+    upload_state = DictUploadState()
+    upload_state.set('s', 'a', 'new')
+    upload_state.load({'s': {'a': 'old', 'b': 'old'}})
+    upload_state.delete('s', 'c')
+    assert upload_state.dump() == {'s': {'a': 'new', 'b': 'old'}}
+
+
+def test_sqlite_upload_state(tmp_path):
+    """ Test hashes kept in a SQLite file """
+    path = tmp_path / 'upload_state.db'
+    upload_state = SqliteUploadState(path)
+    # migrate an older Singer state
+    upload_state.load({'s': {'a': 'h1', 'b': 'h2'}})
+    upload_state.set('s', 'c', 'h3')
+    upload_state.delete('s', 'b')
+    pointer = upload_state.dump()
+    assert pointer == {'backend': 'sqlite', 'path': str(path), 'version': 1}
+    # changes after the last dump are lost with the process
+    upload_state.set('s', 'd', 'h4')
+    upload_state.close()
+
+    upload_state = SqliteUploadState(path)
+    upload_state.load(pointer)
+    assert [upload_state.get('s', x) for x in 'abcd'] == ['h1', None, 'h3', None]
+    upload_state.close()
+
+
+def test_compact_upload_state():
+    """ Test compressed hashes, only changed streams are encoded again """
+    upload_state = DictUploadState(compact=True)
+    upload_state.set('s', 'a', 'h1')
+    upload_state.set('t', 'b', 'h2')
+    value = upload_state.dump()
+    assert value['encoding'] == 'zlib+base64'
+    upload_state.set('t', 'c', 'h3')
+    assert upload_state.changed_streams == {'t'}
+    value = upload_state.dump()
+    restored = DictUploadState()
+    restored.load(value)
+    assert restored.dump() == {'s': {'a': 'h1'}, 't': {'b': 'h2', 'c': 'h3'}}
+
+
+def test_sqlite_upload_state_from_compact(tmp_path):
+    """ Test the compact hashes of the state backend are migrated to SQLite """
+    upload_state = DictUploadState(compact=True)
+    upload_state.set('s', 'a', 'h1')
+    sqlite_state = SqliteUploadState(tmp_path / 'state.db')
+    sqlite_state.load(upload_state.dump())
+    assert sqlite_state.get('s', 'a') == 'h1'
+    sqlite_state.close()